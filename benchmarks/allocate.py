@@ -0,0 +1,56 @@
+"""Allocate latency against batch size and against batches per product.
+
+Run with `python -m benchmarks.allocate`.
+"""
+
+import timeit
+from datetime import date, timedelta
+from typing import Iterator
+
+from ddd_python.domain import model
+
+SIZES = [10, 100, 1_000, 10_000]
+ALLOCATIONS = 200
+
+
+def product_with_lines(lines: int) -> model.Product:
+    batch = model.Batch("batch-001", "GENERIC-SOFA", lines * 2, eta=date.today())
+    for i in range(lines):
+        batch.allocate(model.OrderLine(f"order-{i}", "GENERIC-SOFA", 1))
+    return model.Product("GENERIC-SOFA", [batch])
+
+
+def product_with_batches(batches: int) -> model.Product:
+    # every batch but the last is already full
+    today = date.today()
+    product = model.Product(
+        "GENERIC-SOFA",
+        [
+            model.Batch(f"batch-{i}", "GENERIC-SOFA", 1, eta=today + timedelta(i))
+            for i in range(batches)
+        ],
+    )
+    for i in range(batches - 1):
+        product.allocate(model.OrderLine(f"order-{i}", "GENERIC-SOFA", 1))
+    product.batches[-1]._purchased_quantity = ALLOCATIONS
+    return product
+
+
+def new_lines() -> Iterator[model.OrderLine]:
+    return iter(
+        model.OrderLine(f"new-order-{i}", "GENERIC-SOFA", 1) for i in range(ALLOCATIONS)
+    )
+
+
+def bench(product: model.Product) -> float:
+    lines = new_lines()
+    seconds = timeit.timeit(lambda: product.allocate(next(lines)), number=ALLOCATIONS)
+    return seconds / ALLOCATIONS
+
+
+if __name__ == "__main__":
+    print(f"{'size':>8} {'lines/batch (us)':>18} {'batches/product (us)':>22}")
+    for size in SIZES:
+        by_lines = bench(product_with_lines(size)) * 1e6
+        by_batches = bench(product_with_batches(size)) * 1e6
+        print(f"{size:>8} {by_lines:>18.1f} {by_batches:>22.1f}")
@@ -0,0 +1,61 @@
+"""Bulk allocation of an order drop against one line at a time.
+
+Run with `python -m benchmarks.allocate_many`.
+"""
+
+import random
+import time
+from datetime import date, timedelta
+from typing import List
+
+from ddd_python.domain import model
+
+BATCHES = 500
+LINES = [1_000, 10_000, 50_000]
+
+
+def make_product() -> model.Product:
+    rng = random.Random(42)
+    today = date.today()
+    return model.Product(
+        "GENERIC-SOFA",
+        [
+            model.Batch(
+                f"batch-{i}", "GENERIC-SOFA", rng.randint(1, 400), today + timedelta(i)
+            )
+            for i in range(BATCHES)
+        ],
+    )
+
+
+def make_lines(count: int) -> List[model.OrderLine]:
+    rng = random.Random(7)
+    return [
+        model.OrderLine(f"order-{i}", "GENERIC-SOFA", rng.randint(1, 20))
+        for i in range(count)
+    ]
+
+
+def bench_one_at_a_time(lines: List[model.OrderLine]) -> float:
+    product = make_product()
+    start = time.perf_counter()
+    for line in lines:
+        product.allocate(line)
+    return time.perf_counter() - start
+
+
+def bench_allocate_many(lines: List[model.OrderLine]) -> float:
+    product = make_product()
+    start = time.perf_counter()
+    product.allocate_many(lines)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    print(f"{BATCHES} batches")
+    print(f"{'lines':>8} {'allocate (ms)':>15} {'allocate_many (ms)':>20}")
+    for count in LINES:
+        lines = make_lines(count)
+        one = bench_one_at_a_time(lines) * 1e3
+        many = bench_allocate_many(lines) * 1e3
+        print(f"{count:>8} {one:>15.1f} {many:>20.1f}")
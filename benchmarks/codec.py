@@ -0,0 +1,75 @@
+"""Encoding and decoding events with the codecs against json.dumps(asdict()).
+
+Run with `python -m benchmarks.codec`.
+"""
+
+import json
+import time
+from dataclasses import asdict
+from datetime import date, datetime
+from typing import Callable, List
+
+from ddd_python.adapters import codec
+from ddd_python.domain import commands, events
+
+MESSAGES = 100_000
+
+
+def make_events() -> List[events.BatchCreated]:
+    return [
+        events.BatchCreated("GENERIC-SOFA", f"batch-{i}", date(2021, 10, 7), i)
+        for i in range(MESSAGES)
+    ]
+
+
+def make_commands() -> List[commands.CreateBatch]:
+    return [
+        commands.CreateBatch(f"batch-{i}", "GENERIC-SOFA", i, date(2021, 10, 7))
+        for i in range(MESSAGES)
+    ]
+
+
+def old_encode(message) -> bytes:
+    data = asdict(message)
+    data["eta"] = message.eta.strftime("%m/%d/%Y")
+    return json.dumps(data).encode()
+
+
+def old_decode(payload: bytes) -> commands.CreateBatch:
+    data = json.loads(payload)
+    eta = datetime.strptime(data.get("eta", ""), "%m/%d/%Y").date()
+    return commands.CreateBatch(
+        data.get("ref", ""), data.get("sku", ""), int(data.get("qty", 0)), eta
+    )
+
+
+def bench(fn: Callable, items: list) -> float:
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return time.perf_counter() - start
+
+
+def report(name: str, encode: Callable, decode: Callable):
+    batch_events, batch_commands = make_events(), make_commands()
+    payloads = [encode(command) for command in batch_commands]
+    encode_ms = bench(encode, batch_events) * 1e3
+    decode_ms = bench(decode, payloads) * 1e3
+    size = len(payloads[0])
+    print(f"{name:>10} {encode_ms:>12.0f} {decode_ms:>12.0f} {size:>6}")
+
+
+if __name__ == "__main__":
+    print(f"{MESSAGES} BatchCreated events out, CreateBatch commands in")
+    print(f"{'codec':>10} {'encode (ms)':>12} {'decode (ms)':>12} {'bytes':>6}")
+    report("asdict", old_encode, old_decode)
+    for name in codec.CODECS:
+        try:
+            wire_codec = codec.get_codec(name)
+        except codec.CodecError:  # msgpack is not installed
+            continue
+        report(
+            name,
+            wire_codec.encode,
+            lambda payload: wire_codec.decode(payload, commands.CreateBatch),
+        )
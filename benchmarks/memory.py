@@ -0,0 +1,73 @@
+"""Memory held by a product with 100k order lines, and by queued events.
+
+Run with `python -m benchmarks.memory`.
+"""
+
+import tracemalloc
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from ddd_python.adapters import orm, repository
+from ddd_python.domain import events, model
+
+LINES = 100_000
+
+
+@dataclass
+class DictAllocated:
+    # the pre-__slots__ layout of events.Allocated, for comparison
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+def measure(build: Callable[[], object]) -> int:
+    tracemalloc.start()
+    kept = build()  # noqa: F841
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def load_product(engine) -> Callable[[], object]:
+    def build():
+        session = Session(engine)
+        product = repository.SqlAlchemyProductRepository(session).get("GENERIC-SOFA")
+        product.batches[0].available_quantity
+        return session, product
+
+    return build
+
+
+def seed(engine) -> None:
+    batch = model.Batch("batch-001", "GENERIC-SOFA", LINES, eta=date.today())
+    for i in range(LINES):
+        batch.allocate(model.OrderLine(f"order-{i}", "GENERIC-SOFA", 1))
+    with Session(engine) as session:
+        session.add(model.Product("GENERIC-SOFA", [batch]))
+        session.commit()
+
+
+def make_events(event_type) -> Callable[[], object]:
+    return lambda: [
+        event_type(f"order-{i}", "GENERIC-SOFA", 1, "batch-001") for i in range(LINES)
+    ]
+
+
+if __name__ == "__main__":
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    seed(engine)
+
+    loaded = measure(load_product(engine))
+    slotted = measure(make_events(events.Allocated))
+    unslotted = measure(make_events(DictAllocated))
+    print(f"product with {LINES} lines: {loaded / 2**20:8.1f} MiB")
+    print(f"{LINES} Allocated events:    {slotted / 2**20:8.1f} MiB (slots)")
+    print(f"{LINES} Allocated events:    {unslotted / 2**20:8.1f} MiB (__dict__)")
@@ -0,0 +1,54 @@
+import threading
+import time
+from typing import Callable, Optional
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a dependency that keeps failing.
+
+    After failure_threshold failures in a row the circuit opens and calls
+    fail straight away with CircuitOpen. Once reset_timeout has passed one
+    call is let through, its outcome closes or reopens the circuit.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self.clock() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen()
+            # half open: this call is the probe, the others keep failing fast
+            # until it reports back
+            self.opened_at = self.clock()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
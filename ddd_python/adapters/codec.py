@@ -0,0 +1,239 @@
+"""Wire formats of the events we publish and the commands we consume.
+
+Every message type has a Schema built from its dataclass fields. Payloads
+carry the schema version under "v" (payloads without one are version 1), a
+newer version than ours is refused and older ones go through the schema's
+upgrades first. Decoding builds the dataclass directly from the payload,
+converting each field by its annotation.
+"""
+
+import json
+from abc import ABC, abstractmethod
+from dataclasses import fields
+from datetime import date
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    get_args,
+    get_type_hints,
+)
+
+from ddd_python.domain import commands, events
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Message = Union[commands.Command, events.Event]
+M = TypeVar("M", bound=Message)
+Payload = Union[bytes, str]
+# turns a payload of the previous version into the next one
+Upgrade = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+VERSION_KEY = "v"
+
+
+class CodecError(Exception):
+    pass
+
+
+def _is_date(hint) -> bool:
+    return hint is date or date in get_args(hint)
+
+
+class Schema(Generic[M]):
+    message_type: Type[M]
+    version: int
+    upgrades: Dict[int, Upgrade]
+
+    def __init__(
+        self,
+        message_type: Type,
+        version: int = 1,
+        upgrades: Optional[Dict[int, Upgrade]] = None,
+    ):
+        self.message_type = message_type
+        self.version = version
+        self.upgrades = upgrades or {}
+        hints = get_type_hints(message_type)
+        # (name, is a date, is an int) in constructor order
+        self.fields: List[Tuple[str, bool, bool]] = [
+            (f.name, _is_date(hints[f.name]), hints[f.name] is int)
+            for f in fields(message_type)
+        ]
+
+    def to_dict(self, message: M, encode_date: Callable[[date], Any]) -> Dict[str, Any]:
+        data: Dict[str, Any] = {VERSION_KEY: self.version}
+        for name, is_date, _ in self.fields:
+            value = getattr(message, name)
+            if is_date and value is not None:
+                value = encode_date(value)
+            data[name] = value
+        return data
+
+    def from_dict(self, data: Dict[str, Any], decode_date: Callable[[Any], date]) -> M:
+        version = data.get(VERSION_KEY, 1)
+        if not isinstance(version, int) or version < 1:
+            raise CodecError(f"{self.message_type.__name__} has version {version!r}")
+        if version > self.version:
+            raise CodecError(
+                f"{self.message_type.__name__} v{version} is newer than"
+                f" v{self.version}"
+            )
+        while version < self.version:
+            data = self.upgrades[version](data)
+            version += 1
+        values = []
+        for name, is_date, is_int in self.fields:
+            try:
+                value = data[name]
+            except KeyError:
+                raise CodecError(
+                    f"{self.message_type.__name__} payload has no {name}"
+                ) from None
+            if value is not None:
+                if is_date:
+                    value = decode_date(value)
+                elif is_int and not isinstance(value, int):
+                    value = int(value)
+            values.append(value)
+        return self.message_type(*values)
+
+
+def _schemas(*message_types: Type) -> Dict[Type, Schema]:
+    return {message_type: Schema(message_type) for message_type in message_types}
+
+
+SCHEMAS: Dict[Type, Schema] = _schemas(
+    events.Allocated,
+    events.Deallocated,
+    events.Reallocated,
+    events.OutOfStock,
+    events.ProductCreated,
+    events.BatchCreated,
+    events.BatchQuantityChanged,
+    commands.Allocate,
+    commands.Deallocate,
+    commands.CreateBatch,
+    commands.ChangeBatchQuantity,
+    commands.CreateProduct,
+)
+SCHEMAS_BY_NAME: Dict[str, Schema] = {
+    message_type.__name__: schema for message_type, schema in SCHEMAS.items()
+}
+
+
+class AbstractCodec(ABC):
+    name: str
+
+    def encode(self, message: Message) -> bytes:
+        return self._dumps(SCHEMAS[type(message)].to_dict(message, self._date_out))
+
+    def decode(self, payload: Payload, message_type: Type[M]) -> M:
+        try:
+            data = self._loads(payload)
+        except (ValueError, TypeError) as e:
+            raise CodecError(f"undecodable {message_type.__name__}: {e}") from e
+        if not isinstance(data, dict):
+            raise CodecError(f"{message_type.__name__} payload is not a mapping")
+        try:
+            return SCHEMAS[message_type].from_dict(data, self._date_in)
+        except (ValueError, TypeError) as e:
+            raise CodecError(f"invalid {message_type.__name__}: {e}") from e
+
+    @abstractmethod
+    def _dumps(self, data: Dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _loads(self, payload: Payload) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _date_out(self, value: date) -> Any:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _date_in(self, value: Any) -> date:
+        raise NotImplementedError
+
+
+class JsonCodec(AbstractCodec):
+    """JSON with m/d/Y dates, the format the other services already speak.
+
+    Uses orjson when it is installed.
+    """
+
+    name = "json"
+    DATE_FORMAT = "%m/%d/%Y"
+
+    def _dumps(self, data: Dict[str, Any]) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def _loads(self, payload: Payload) -> Dict[str, Any]:
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(payload)
+
+    def _date_out(self, value: date) -> str:
+        # strftime is slow, the format is fixed
+        return f"{value.month:02}/{value.day:02}/{value.year:04}"
+
+    def _date_in(self, value: Any) -> date:
+        if not isinstance(value, str):
+            raise CodecError(f"{value!r} is not a m/d/Y date")
+        month, day, year = value.split("/")
+        return date(int(year), int(month), int(day))
+
+
+class MsgpackCodec(AbstractCodec):
+    """Binary msgpack, dates travel as proleptic ordinals."""
+
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise CodecError("the msgpack codec needs the msgpack package")
+
+    def _dumps(self, data: Dict[str, Any]) -> bytes:
+        return msgpack.packb(data)
+
+    def _loads(self, payload: Payload) -> Dict[str, Any]:
+        return msgpack.unpackb(payload)
+
+    def _date_out(self, value: date) -> int:
+        return value.toordinal()
+
+    def _date_in(self, value: Any) -> date:
+        if not isinstance(value, int):
+            raise CodecError(f"{value!r} is not a date ordinal")
+        return date.fromordinal(value)
+
+
+CODECS: Dict[str, Type[AbstractCodec]] = {
+    JsonCodec.name: JsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name: str) -> AbstractCodec:
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"unknown codec {name!r}") from None
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from ddd_python import config, metrics
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+def build_engine(uri: str, **kwargs) -> Engine:
+    settings = dict(
+        isolation_level=config.isolation_level,
+        poolclass=TimedQueuePool,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout,
+        pool_recycle=config.db_pool_recycle,
+        pool_pre_ping=config.db_pool_pre_ping,
+        echo=False,
+    )
+    settings.update(kwargs)
+    return create_engine(uri, **settings)
+
+
+_engine: Optional[Engine] = None
+_session_factory: Optional[sessionmaker] = None
+_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    # created on first use, so importing the app (or forking gunicorn
+    # workers) does not open a pool
+    global _engine, _session_factory
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                _engine = build_engine(config.postgres_uri)
+                if metrics.REGISTRY.enabled:
+                    instrument_engine(_engine)
+                _session_factory = sessionmaker(
+                    bind=_engine,
+                    # keeps committed aggregates loaded so they can be cached
+                    # across sessions
+                    expire_on_commit=False,
+                )
+    return _engine
+
+
+def create_session() -> Session:
+    get_engine()
+    session_factory = _session_factory
+    assert session_factory is not None, "get_engine creates the session factory"
+    return session_factory()
+
+
+def dispose_engine() -> None:
+    global _engine, _session_factory
+    with _lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = _session_factory = None
+
+
+def _after_fork_in_child() -> None:
+    # connections inherited from the parent process belong to the parent,
+    # drop them without closing so the parent's sockets stay usable
+    if _engine is not None:
+        _engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def pool_metrics(engine: Optional[Engine] = None) -> Dict[str, float]:
+    engine = engine or _engine
+    if engine is None:
+        return {}
+    pool = engine.pool
+    metrics: Dict[str, float] = {}
+    if isinstance(pool, QueuePool):
+        metrics.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, TimedQueuePool):
+        metrics.update(
+            checkouts=pool.checkouts,
+            timeouts=pool.timeouts,
+            wait_seconds=pool.wait_seconds,
+            max_wait_seconds=pool.max_wait_seconds,
+        )
+    return metrics
+
+
+def _pool_samples() -> List[metrics.Sample]:
+    return [(f"db_pool_{name}", {}, value) for name, value in pool_metrics().items()]
+
+
+metrics.REGISTRY.add_collector(_pool_samples)
+
+# statements run by the current thread since start_sql_stats: [count, seconds]
+_sql_stats = threading.local()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    context._metrics_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    stats = getattr(_sql_stats, "current", None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - context._metrics_started_at
+
+
+def instrument_engine(engine: Engine) -> None:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def start_sql_stats() -> None:
+    _sql_stats.current = [0, 0.0]
+
+
+def stop_sql_stats() -> Optional[Tuple[int, float]]:
+    """Statement count and time since start_sql_stats on this thread."""
+    stats = getattr(_sql_stats, "current", None)
+    _sql_stats.current = None
+    return None if stats is None else (stats[0], stats[1])
@@ -0,0 +1,111 @@
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from ddd_python.domain import events
+
+from . import codec, orm
+
+
+@dataclass
+class DeadLetter:
+    handler: str
+    event: events.Event
+    error: str
+    attempts: int
+    id: Optional[int] = None
+
+
+# dead letters are stored as json, so they can be read in the table
+_CODEC = codec.JsonCodec()
+
+
+def encode_event(event: events.Event) -> str:
+    return _CODEC.encode(event).decode()
+
+
+def decode_event(message_type: str, payload: str) -> events.Event:
+    return _CODEC.decode(payload, codec.SCHEMAS_BY_NAME[message_type].message_type)
+
+
+class AbstractDeadLetterStore(ABC):
+    @abstractmethod
+    def add(self, letter: DeadLetter) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list(self) -> List[DeadLetter]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, letter_id: int) -> None:
+        raise NotImplementedError
+
+
+class FakeDeadLetterStore(AbstractDeadLetterStore):
+    letters: Dict[int, DeadLetter]
+
+    def __init__(self):
+        self.letters = {}
+        self._lock = threading.Lock()
+
+    def add(self, letter: DeadLetter) -> None:
+        with self._lock:
+            letter.id = len(self.letters) + 1
+            self.letters[letter.id] = letter
+
+    def list(self) -> List[DeadLetter]:
+        return list(self.letters.values())
+
+    def remove(self, letter_id: int) -> None:
+        with self._lock:
+            self.letters.pop(letter_id, None)
+
+
+class SqlAlchemyDeadLetterStore(AbstractDeadLetterStore):
+    session_factory: Callable[[], Session]
+
+    def __init__(self, session_factory: Callable[[], Session]):
+        self.session_factory = session_factory
+
+    def add(self, letter: DeadLetter) -> None:
+        with self.session_factory() as session:
+            session.execute(
+                insert(orm.dead_letters).values(
+                    handler=letter.handler,
+                    message_type=type(letter.event).__name__,
+                    payload=encode_event(letter.event),
+                    error=letter.error,
+                    attempts=letter.attempts,
+                    failed_at=datetime.utcnow(),
+                )
+            )
+            session.commit()
+
+    def list(self) -> List[DeadLetter]:
+        with self.session_factory() as session:
+            rows = session.execute(
+                select(orm.dead_letters).order_by(orm.dead_letters.c.id)
+            )
+            return [
+                DeadLetter(
+                    handler=row.handler,
+                    event=decode_event(row.message_type, row.payload),
+                    error=row.error,
+                    attempts=row.attempts,
+                    id=row.id,
+                )
+                for row in rows
+            ]
+
+    def remove(self, letter_id: int) -> None:
+        with self.session_factory() as session:
+            session.execute(
+                delete(orm.dead_letters).where(orm.dead_letters.c.id == letter_id)
+            )
+            session.commit()
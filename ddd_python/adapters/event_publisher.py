@@ -1,21 +1,38 @@
-import json
 from abc import ABC, abstractmethod
-from dataclasses import asdict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from redis import Redis
+from redis.client import Pipeline
 
+from ddd_python import config, metrics
 from ddd_python.domain import events
 
+from . import codec, redis_client, redis_streams
+from .circuit_breaker import CircuitBreaker
+
+PUBLISH_SECONDS = metrics.REGISTRY.histogram(
+    "redis_publish_seconds", "Time redis took to accept published messages", ["call"]
+)
+
+# (channel, already encoded payload)
+EncodedMessage = Tuple[str, bytes]
+
 
 class AbstractPublisherAdapter(ABC):
     @abstractmethod
     def publish(self, channel: str, event: events.Event):
         raise NotImplementedError
 
+    @abstractmethod
+    def publish_encoded(self, messages: Iterable[EncodedMessage]):
+        raise NotImplementedError
+
 
 class FakePublisherAdapter(AbstractPublisherAdapter):
+    published_messages: Dict[str, List[bytes]]
+
     def __init__(self):
         self.published_events = {}
+        self.published_messages = {}
 
     def publish(self, channel: str, event: events.Event):
         if channel in self.published_events:
@@ -23,13 +40,83 @@ class FakePublisherAdapter(AbstractPublisherAdapter):
         else:
             self.published_events[channel] = [event]
 
+    def publish_encoded(self, messages: Iterable[EncodedMessage]):
+        for channel, payload in messages:
+            self.published_messages.setdefault(channel, []).append(payload)
+
+
+# shared by every redis publisher of the process
+BREAKER = CircuitBreaker(
+    config.publisher_failure_threshold, config.publisher_reset_timeout
+)
+
 
 class RedisPublisherAdapter(AbstractPublisherAdapter):
-    def __init__(self, host: str, port: int):
-        self.r = Redis(
-            host=host,
-            port=port,
-        )
+    """Publishes on the process-wide redis pool.
+
+    publish_encoded sends a batch in one pipeline. Once redis has failed
+    often enough the circuit breaker makes publishes raise CircuitOpen at once
+    instead of waiting on it, until it has had time to recover. Messages are
+    not kept here, the outbox relay publishes them again.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        breaker: CircuitBreaker = BREAKER,
+        wire_codec: Optional[codec.AbstractCodec] = None,
+    ):
+        self.r = redis_client.get_redis(host, port)
+        self.codec = wire_codec or codec.get_codec(config.wire_codec)
+        self.breaker = breaker
 
     def publish(self, channel: str, event: events.Event):
-        self.r.publish(channel, json.dumps(asdict(event)))
+        self.publish_encoded([(channel, self.codec.encode(event))])
+
+    def publish_encoded(self, messages: Iterable[EncodedMessage]):
+        self.breaker.before_call()
+        # one round trip for the whole batch
+        pipeline = self.r.pipeline(transaction=False)
+        for channel, payload in messages:
+            self._send(pipeline, channel, payload)
+        try:
+            with PUBLISH_SECONDS.time("pipeline"):
+                pipeline.execute()
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    def _send(self, pipeline: Pipeline, channel: str, payload: bytes):
+        pipeline.publish(channel, payload)
+
+
+class RedisStreamPublisherAdapter(RedisPublisherAdapter):
+    """Appends to the stream of each channel instead of publishing on it.
+
+    Entries wait in the stream until a consumer group has read them, streams
+    are trimmed to about stream_maxlen entries.
+    """
+
+    def __init__(
+        self, host: str, port: int, stream_maxlen: int = config.stream_maxlen, **kwargs
+    ):
+        super().__init__(host, port, **kwargs)
+        self.stream_maxlen = stream_maxlen
+
+    def _send(self, pipeline: Pipeline, channel: str, payload: bytes):
+        pipeline.xadd(
+            channel,
+            {redis_streams.DATA_FIELD: payload},
+            maxlen=self.stream_maxlen,
+            approximate=True,
+        )
+
+
+def build_publisher(
+    host: str = config.redis_host, port: int = config.redis_port
+) -> RedisPublisherAdapter:
+    if config.redis_transport == "streams":
+        return RedisStreamPublisherAdapter(host, port)
+    return RedisPublisherAdapter(host, port)
@@ -1,4 +1,19 @@
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table
+from typing import Optional
+
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    Text,
+    event,
+)
 from sqlalchemy.orm import registry, relationship
 
 from ddd_python.domain import model
@@ -59,6 +74,30 @@ batches_view = Table(
     Column("qty", Integer),
 )
 
+dead_letters = Table(
+    "dead_letters",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("handler", String(255), nullable=False),
+    Column("message_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("error", Text),
+    Column("attempts", Integer, nullable=False),
+    Column("failed_at", DateTime, nullable=False),
+)
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", LargeBinary, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("sent_at", DateTime),
+    # the relay looks for unsent rows in id order
+    Index("ix_outbox_sent_at_id", "sent_at", "id"),
+)
+
 
 def start_mappers():
     mapper_registry.map_imperatively(model.OrderLine, order_lines)
@@ -67,14 +106,31 @@ def start_mappers():
         batches,
         properties={
             "_purchased_quantity": batches.c.qty,
-            "allocations": relationship(model.OrderLine, backref="batch"),
+            "allocations": relationship(
+                model.OrderLine,
+                backref="batch",
+                collection_class=model.Allocations,
+                order_by=order_lines.c.id,
+            ),
         },
     ),
     mapper_registry.map_imperatively(
         model.Product,
         products,
         properties={"batches": relationship(model.Batch, backref="product")},
+        # the aggregate bumps version_number itself, the ORM then only updates
+        # the row if nobody else bumped it first
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
+    if not event.contains(model.Product, "expire", _invalidate_product_indexes):
+        event.listen(model.Product, "expire", _invalidate_product_indexes)
+
+
+def _invalidate_product_indexes(product: Optional[model.Product], *args):
+    # the batches of an expired product are reloaded on next access
+    if product is not None:
+        product.invalidate_indexes()
 
 
 def clear_mappers():
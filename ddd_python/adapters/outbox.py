@@ -0,0 +1,88 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Type
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from ddd_python import config
+from ddd_python.domain import events
+
+from . import codec, orm
+from .event_publisher import AbstractPublisherAdapter
+
+# events that leave the service and the redis channel each one goes out on
+CHANNELS: Dict[Type[events.Event], str] = {
+    events.Allocated: "line_allocated",
+    events.Deallocated: "line_deallocated",
+    events.Reallocated: "line_reallocated",
+    events.ProductCreated: "product_created",
+    events.BatchCreated: "batch_created",
+    events.BatchQuantityChanged: "batch_quantity_changed",
+}
+
+
+@dataclass
+class OutboxMessage:
+    channel: str
+    payload: bytes
+    id: Optional[int] = None
+
+
+# payloads are encoded when they are written, the relay sends them as they are
+CODEC = codec.get_codec(config.wire_codec)
+
+
+def to_messages(
+    new_events: Iterable[events.Event], wire_codec: codec.AbstractCodec = CODEC
+) -> List[OutboxMessage]:
+    return [
+        OutboxMessage(CHANNELS[type(event)], wire_codec.encode(event))
+        for event in new_events
+        if type(event) in CHANNELS
+    ]
+
+
+class OutboxRelay:
+    """Publishes outbox rows that have not been sent yet, oldest first.
+
+    Rows are marked sent in the transaction that read them, after redis took
+    the batch. A crash in between publishes them again: delivery is at least
+    once, consumers have to tolerate duplicates.
+    """
+
+    session_factory: Callable[[], Session]
+    publisher: AbstractPublisherAdapter
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        publisher: AbstractPublisherAdapter,
+        batch_size: int = 500,
+    ):
+        self.session_factory = session_factory
+        self.publisher = publisher
+        self.batch_size = batch_size
+
+    def relay_once(self) -> int:
+        """Publishes one batch, returns how many rows it held."""
+        outbox = orm.outbox.c
+        with self.session_factory() as session:
+            rows = session.execute(
+                select(outbox.id, outbox.channel, outbox.payload)
+                .where(outbox.sent_at.is_(None))
+                .order_by(outbox.id)
+                .limit(self.batch_size)
+                # concurrent relays each take a batch of their own
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                return 0
+            self.publisher.publish_encoded((row.channel, row.payload) for row in rows)
+            session.execute(
+                update(orm.outbox)
+                .where(outbox.id.in_([row.id for row in rows]))
+                .values(sent_at=datetime.utcnow())
+            )
+            session.commit()
+            return len(rows)
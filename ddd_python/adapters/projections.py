@@ -0,0 +1,313 @@
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from sqlalchemy import and_, bindparam, delete, insert, update
+from sqlalchemy.orm import Session
+
+from . import orm
+
+logger = logging.getLogger(__name__)
+
+AllocationKey = Tuple[str, str]
+Change = Callable[["Changes"], None]
+
+
+class ProjectionBacklogFull(Exception):
+    pass
+
+
+@dataclass
+class AllocationChange:
+    # the row is deleted first, then inserted or updated with batchref
+    delete: bool = False
+    write: Optional[str] = None  # "insert" or "update"
+    batchref: Optional[str] = None
+
+
+@dataclass
+class Changes:
+    """Read model mutations waiting to be flushed, already collapsed."""
+
+    allocations: Dict[AllocationKey, AllocationChange] = field(default_factory=dict)
+    products: Dict[str, None] = field(default_factory=dict)
+    batches: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    batch_qtys: Dict[str, int] = field(default_factory=dict)
+    recorded: int = 0
+
+    def __len__(self):
+        return self.recorded
+
+    def insert_allocation(self, orderid: str, sku: str, batchref: str):
+        change = self.allocations.setdefault((orderid, sku), AllocationChange())
+        change.write, change.batchref = "insert", batchref
+
+    def remove_allocation(self, orderid: str, sku: str):
+        key = (orderid, sku)
+        change = self.allocations.get(key)
+        if change is not None and change.write == "insert" and not change.delete:
+            # the row was never written, there is nothing to delete
+            del self.allocations[key]
+            return
+        self.allocations[key] = AllocationChange(delete=True)
+
+    def update_allocation(self, orderid: str, sku: str, batchref: str):
+        change = self.allocations.setdefault((orderid, sku), AllocationChange())
+        if change.write is not None:
+            change.batchref = batchref
+        elif not change.delete:  # an update of a deleted row changes nothing
+            change.write, change.batchref = "update", batchref
+
+    def insert_product(self, sku: str):
+        self.products[sku] = None
+
+    def insert_batch(
+        self, sku: str, reference: str, eta: Optional[Union[str, date]], qty: int
+    ):
+        self.batches[reference] = {
+            "sku": sku,
+            "reference": reference,
+            "eta": eta,
+            "qty": qty,
+        }
+
+    def update_batch_qty(self, reference: str, qty: int):
+        if reference in self.batches:
+            self.batches[reference]["qty"] = qty
+        else:
+            self.batch_qtys[reference] = qty
+
+
+class AbstractProjectionWriter(ABC):
+    """Buffers read model mutations and writes them in bulk.
+
+    Handlers record changes, the bus calls flush_if_due() at the end of each
+    cycle. With a flush_interval the changes of several cycles are collapsed
+    and written together, at the cost of the views lagging behind by up to
+    that long.
+    """
+
+    def __init__(self, flush_interval: float = 0.0, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._changes = Changes()
+        self._started_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _record(self, change: Change):
+        self._ensure_capacity()
+        self._apply(change)
+
+    def _ensure_capacity(self):
+        """Raises ProjectionBacklogFull when no more changes can be taken."""
+
+    def _apply(self, change: Change):
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = time.monotonic()
+                if self.flush_interval > 0:
+                    # flushes the window even if no bus cycle ends after it
+                    timer = threading.Timer(self.flush_interval, self.flush)
+                    timer.daemon = True
+                    timer.start()
+            change(self._changes)
+            self._changes.recorded += 1
+
+    def insert_allocation(self, orderid: str, sku: str, batchref: str):
+        self._record(lambda c: c.insert_allocation(orderid, sku, batchref))
+
+    def remove_allocation(self, orderid: str, sku: str):
+        self._record(lambda c: c.remove_allocation(orderid, sku))
+
+    def update_allocation(self, orderid: str, sku: str, batchref: str):
+        self._record(lambda c: c.update_allocation(orderid, sku, batchref))
+
+    def insert_product(self, sku: str):
+        self._record(lambda c: c.insert_product(sku))
+
+    def insert_batch(
+        self, sku: str, reference: str, eta: Optional[Union[str, date]], qty: int
+    ):
+        self._record(lambda c: c.insert_batch(sku, reference, eta, qty))
+
+    def update_batch_qty(self, reference: str, qty: int):
+        self._record(lambda c: c.update_batch_qty(reference, qty))
+
+    def pending(self) -> int:
+        return len(self._changes)
+
+    def flush_if_due(self):
+        started_at = self._started_at
+        if started_at is None:
+            return
+        if (
+            len(self._changes) >= self.max_pending
+            or time.monotonic() - started_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def _take(self) -> Optional[Changes]:
+        with self._lock:
+            if self._started_at is None:
+                return None
+            changes, self._changes = self._changes, Changes()
+            self._started_at = None
+            return changes
+
+    @abstractmethod
+    def flush(self):
+        raise NotImplementedError
+
+
+class HeldProjectionWriter(AbstractProjectionWriter):
+    """Holds the changes of a unit of work batch until the batch commits.
+
+    The changes are handed to the target writer on release, or dropped on
+    discard when the batch rolls back, so the views never show rows of a
+    transaction that did not commit.
+    """
+
+    def __init__(self, target: AbstractProjectionWriter):
+        super().__init__()
+        self.target = target
+        self._held: List[Change] = []
+
+    def _record(self, change: Change):
+        # a full backlog fails the handler now, not the batch's commit
+        self.target._ensure_capacity()
+        self._held.append(change)
+
+    def pending(self) -> int:
+        return len(self._held)
+
+    def flush(self):
+        # nothing is written before release()
+        pass
+
+    def release(self):
+        held, self._held = self._held, []
+        for change in held:
+            self.target._apply(change)
+
+    def discard(self):
+        self._held.clear()
+
+
+class FakeProjectionWriter(AbstractProjectionWriter):
+    flushed: List[Changes]
+
+    def __init__(self, flush_interval: float = 0.0, max_pending: int = 1000):
+        super().__init__(flush_interval, max_pending)
+        self.flushed = []
+
+    def flush(self):
+        changes = self._take()
+        if changes is not None:
+            self.flushed.append(changes)
+
+
+class SqlAlchemyProjectionWriter(AbstractProjectionWriter):
+    session_factory: Callable[[], Session]
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        flush_interval: float = 0.0,
+        max_pending: int = 1000,
+        max_failed: int = 100,
+    ):
+        super().__init__(flush_interval, max_pending)
+        self.session_factory = session_factory
+        self.max_failed = max_failed
+        # flushes that failed, written again before anything newer
+        self._failed: Deque[Changes] = deque()
+        self._flush_lock = threading.Lock()
+
+    def _ensure_capacity(self):
+        # past max_failed the handlers recording changes fail instead, so
+        # their events go through the retries and the dead letters
+        if len(self._failed) >= self.max_failed:
+            raise ProjectionBacklogFull(
+                f"{len(self._failed)} read model flushes are waiting to be written"
+            )
+
+    def flush_if_due(self):
+        if self._failed:
+            self.flush()
+            return
+        super().flush_if_due()
+
+    def flush(self):
+        # one flush at a time, so changes reach the views in the order they
+        # were recorded
+        with self._flush_lock:
+            changes = self._take()
+            if changes is not None:
+                self._failed.append(changes)
+            while self._failed:
+                try:
+                    self._write(self._failed[0])
+                except Exception:
+                    logger.exception(
+                        "read model flush failed, %s kept for the next one",
+                        len(self._failed),
+                    )
+                    return
+                self._failed.popleft()
+
+    def _write(self, changes: Changes):
+        allocations = orm.allocations_view.c
+        deletes, updates, inserts = [], [], []
+        for (orderid, sku), change in changes.allocations.items():
+            key = {"b_orderid": orderid, "b_sku": sku}
+            if change.delete:
+                deletes.append(key)
+            if change.write == "update":
+                updates.append(dict(key, b_batchref=change.batchref))
+            elif change.write == "insert":
+                inserts.append(
+                    {"orderid": orderid, "sku": sku, "batchref": change.batchref}
+                )
+        same_line = and_(
+            allocations.orderid == bindparam("b_orderid"),
+            allocations.sku == bindparam("b_sku"),
+        )
+
+        with self.session_factory() as session:
+            # executemany per statement, every statement in one transaction
+            if deletes:
+                session.execute(delete(orm.allocations_view).where(same_line), deletes)
+            if updates:
+                session.execute(
+                    update(orm.allocations_view)
+                    .where(same_line)
+                    .values(batchref=bindparam("b_batchref")),
+                    updates,
+                )
+            if inserts:
+                session.execute(insert(orm.allocations_view), inserts)
+            if changes.products:
+                session.execute(
+                    insert(orm.products_view),
+                    [{"sku": sku} for sku in changes.products],
+                )
+            if changes.batches:
+                session.execute(
+                    insert(orm.batches_view), list(changes.batches.values())
+                )
+            if changes.batch_qtys:
+                session.execute(
+                    update(orm.batches_view)
+                    .where(orm.batches_view.c.reference == bindparam("b_reference"))
+                    .values(qty=bindparam("b_qty")),
+                    [
+                        {"b_reference": ref, "b_qty": qty}
+                        for ref, qty in changes.batch_qtys.items()
+                    ],
+                )
+            session.commit()
@@ -0,0 +1,44 @@
+import os
+import threading
+from typing import Dict, Tuple
+
+from redis import ConnectionPool, Redis
+
+from ddd_python import config
+
+_pools: Dict[Tuple[str, int], ConnectionPool] = {}
+_lock = threading.Lock()
+
+
+def get_redis(host: str = config.redis_host, port: int = config.redis_port) -> Redis:
+    """A client on the process-wide connection pool of host:port.
+
+    Clients are cheap, the pool holds the sockets, so callers can build one
+    whenever they need it.
+    """
+    key = (host, port)
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    host=host,
+                    port=port,
+                    max_connections=config.redis_max_connections,
+                    # a slow redis fails fast instead of holding up callers
+                    socket_timeout=config.redis_socket_timeout,
+                    socket_connect_timeout=config.redis_socket_timeout,
+                )
+    return Redis(connection_pool=pool)
+
+
+def _after_fork_in_child() -> None:
+    # sockets inherited from the parent belong to the parent
+    global _lock
+    _pools.clear()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,191 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Sequence
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+DATA_FIELD = b"data"
+# entries that failed max_deliveries times move to "<stream>:dead", with the id
+# they had in their stream
+DEAD_LETTER_SUFFIX = ":dead"
+ID_FIELD = b"id"
+# the cursor XAUTOCLAIM returns once it has scanned the whole pending list
+_SCAN_DONE = (b"0-0", "0-0")
+
+
+@dataclass
+class StreamMessage:
+    stream: str
+    id: bytes
+    data: bytes
+
+
+def _messages(stream: str, entries) -> List[StreamMessage]:
+    return [
+        StreamMessage(stream, entry_id, fields[DATA_FIELD])
+        # entries deleted from the stream while pending come back empty
+        for entry_id, fields in entries
+        if fields
+    ]
+
+
+class StreamConsumer:
+    """Reads streams as one consumer of a consumer group.
+
+    Every entry goes to a single consumer of the group and stays pending until
+    it is acked. Entries left pending for claim_idle_ms, by a consumer that
+    crashed or because handling them failed, are claimed again, so each entry
+    is handled at least once. An entry delivered max_deliveries times without
+    being acked is moved to the stream's dead letter stream.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        group: str,
+        consumer: str,
+        streams: Sequence[str],
+        batch_size: int = 100,
+        block_ms: int = 1000,
+        claim_idle_ms: int = 60_000,
+        max_deliveries: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.redis = redis
+        self.group = group
+        self.consumer = consumer
+        self.streams = list(streams)
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.clock = clock
+        self._claimed_at = float("-inf")
+        # where the scan of each stream's pending list resumes, empty once
+        # every list has been scanned
+        self._claim_cursors: Dict[str, bytes] = {}
+
+    def ensure_groups(self):
+        for stream in self.streams:
+            try:
+                # new groups start at the end of the stream, mkstream creates
+                # the streams nobody has published to yet
+                self.redis.xgroup_create(stream, self.group, id="$", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def claim(self) -> List[StreamMessage]:
+        """Takes over up to batch_size entries left pending too long.
+
+        The pending lists are scanned a page at a time, a call resumes the scan
+        where the previous one stopped and starts a new one once it is over.
+        """
+        if not self._claim_cursors:
+            self._claim_cursors = {stream: b"0-0" for stream in self.streams}
+        claimed: List[StreamMessage] = []
+        for stream, cursor in list(self._claim_cursors.items()):
+            while len(claimed) < self.batch_size:
+                response = self.redis.xautoclaim(
+                    stream,
+                    self.group,
+                    self.consumer,
+                    min_idle_time=self.claim_idle_ms,
+                    start_id=cursor,
+                    count=self.batch_size - len(claimed),
+                )
+                cursor = response[0]
+                claimed.extend(_messages(stream, response[1]))
+                if cursor in _SCAN_DONE:
+                    del self._claim_cursors[stream]
+                    break
+                self._claim_cursors[stream] = cursor
+            if len(claimed) >= self.batch_size:
+                break
+        return claimed
+
+    def read(self) -> List[StreamMessage]:
+        """Up to batch_size entries, waiting at most block_ms for new ones."""
+        # reclaiming is a scan of the pending lists, a scan starts once per
+        # idle period and then runs on every read until it is over
+        scanning = bool(self._claim_cursors)
+        if scanning or self.clock() - self._claimed_at >= self.claim_idle_ms / 1000:
+            if not scanning:
+                self._claimed_at = self.clock()
+            claimed = self.claim()
+            if claimed:
+                return claimed
+        response = self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {stream: ">" for stream in self.streams},
+            count=self.batch_size,
+            block=self.block_ms,
+        )
+        messages = []
+        for stream, entries in response or []:
+            if isinstance(stream, bytes):
+                stream = stream.decode()
+            messages.extend(_messages(stream, entries))
+        return messages
+
+    def ack(self, messages: Iterable[StreamMessage]):
+        ids: Dict[str, List[bytes]] = {}
+        for message in messages:
+            ids.setdefault(message.stream, []).append(message.id)
+        if not ids:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for stream, stream_ids in ids.items():
+            pipeline.xack(stream, self.group, *stream_ids)
+        pipeline.execute()
+
+    def deliveries(self, messages: Sequence[StreamMessage]) -> List[int]:
+        """How many times each message was delivered, taken from XPENDING."""
+        pipeline = self.redis.pipeline(transaction=False)
+        for message in messages:
+            pipeline.xpending_range(
+                message.stream, self.group, min=message.id, max=message.id, count=1
+            )
+        return [
+            pending[0]["times_delivered"] if pending else 0
+            for pending in pipeline.execute()
+        ]
+
+    def fail(self, messages: Sequence[StreamMessage]) -> List[StreamMessage]:
+        """Leaves messages that could not be handled pending, to be claimed again.
+
+        Those already delivered max_deliveries times are dead lettered
+        instead, and returned.
+        """
+        if not messages:
+            return []
+        exhausted = [
+            message
+            for message, delivered in zip(messages, self.deliveries(messages))
+            if delivered >= self.max_deliveries
+        ]
+        if exhausted:
+            self.dead_letter(exhausted)
+        return exhausted
+
+    def dead_letter(self, messages: Iterable[StreamMessage]):
+        """Moves messages to the dead letter stream of their stream."""
+        pipeline = self.redis.pipeline(transaction=False)
+        for message in messages:
+            logger.error(
+                "dead lettering %s %s after %s deliveries",
+                message.stream,
+                message.id,
+                self.max_deliveries,
+            )
+            pipeline.xadd(
+                message.stream + DEAD_LETTER_SUFFIX,
+                {DATA_FIELD: message.data, ID_FIELD: message.id},
+            )
+            pipeline.xack(message.stream, self.group, message.id)
+        pipeline.execute()
@@ -1,7 +1,10 @@
+import threading
 from abc import ABC, abstractmethod
-from typing import List, Set
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload, selectinload
 
 from ddd_python.domain import model
 
@@ -24,12 +27,21 @@ class AbstractProductRepository(ABC):
             self.seen.add(product)
         return product
 
+    def get_many(self, skus: Iterable[str]) -> List[model.Product]:
+        products = self._get_many(list(skus))
+        self.seen.update(products)
+        return products
+
     def get_by_batchref(self, batchref) -> model.Product:
         product = self._get_by_batchref(batchref)
         if product:
             self.seen.add(product)
         return product
 
+    @abstractmethod
+    def register_batchref(self, batchref: str, sku: str):
+        raise NotImplementedError
+
     @abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -38,6 +50,10 @@ class AbstractProductRepository(ABC):
     def _get(self, sku: str) -> model.Product:
         raise NotImplementedError
 
+    @abstractmethod
+    def _get_many(self, skus: List[str]) -> List[model.Product]:
+        raise NotImplementedError
+
     @abstractmethod
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
@@ -46,50 +62,278 @@ class AbstractProductRepository(ABC):
     def list(self) -> List[model.Product]:
         raise NotImplementedError
 
+    @abstractmethod
+    def stream(self, chunk_size: int = 1000) -> Iterator[model.Product]:
+        # products are read only here, so they are not added to seen
+        raise NotImplementedError
+
 
 class FakeProductRepository(AbstractProductRepository):
-    _products: Set[model.Product]
+    _products: Dict[str, model.Product]
+    _batchrefs: Dict[str, str]
 
     def __init__(self, products: List[model.Product]):
         super().__init__()
-        self._products = set(products)
+        self._products = {}
+        self._batchrefs = {}
+        for product in products:
+            self._add(product)
 
     def _add(self, product: model.Product):
-        self._products.add(product)
+        self._products[product.sku] = product
+        self._index_batches(product)
+
+    def _index_batches(self, product: model.Product):
+        for batch in product.batches:
+            self._batchrefs[batch.reference] = product.sku
 
     def _get(self, sku: str):
-        return next(p for p in self._products if p.sku == sku)
+        return self._products.get(sku)
+
+    def _get_many(self, skus: List[str]):
+        return [self._products[sku] for sku in skus if sku in self._products]
 
     def _get_by_batchref(self, batchref):
-        return next(
-            (p for p in self._products for b in p.batches if b.reference == batchref),
-            None,
-        )
+        if batchref not in self._batchrefs:
+            # batches added to a product without a BatchCreated event
+            for product in self._products.values():
+                self._index_batches(product)
+        sku = self._batchrefs.get(batchref)
+        return self._products.get(sku) if sku else None
+
+    def register_batchref(self, batchref: str, sku: str):
+        self._batchrefs[batchref] = sku
 
     def list(self):
-        return list(self._products)
+        return list(self._products.values())
+
+    def stream(self, chunk_size: int = 1000):
+        return iter(list(self._products.values()))
+
+
+class ProductCache:
+    """Process-wide LRU of detached Product aggregates keyed by sku.
+
+    A product is checked out while a session uses it, so two sessions never
+    share an aggregate, and checked back in once its session has committed.
+    Entries are only trusted while their version_number matches the database.
+    """
+
+    max_entries: int
+    hits: int
+    misses: int
+    stale: int
+    evictions: int
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._products: "OrderedDict[str, model.Product]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def checkout(self, sku: str) -> Optional[model.Product]:
+        with self._lock:
+            product = self._products.pop(sku, None)
+            if product is None:
+                self.misses += 1
+            return product
+
+    def checkin(self, product: model.Product) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._products[product.sku] = product
+            self._products.move_to_end(product.sku)
+            while len(self._products) > self.max_entries:
+                self._products.popitem(last=False)
+                self.evictions += 1
+
+    def record_hit(self) -> None:
+        with self._lock:
+            self.hits += 1
+
+    def record_stale(self) -> None:
+        with self._lock:
+            self.stale += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._products.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._products),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+        }
+
+
+class BatchrefIndex:
+    """Process-wide, bounded map of batch reference to product sku.
+
+    A batch never changes product, so entries never go stale. They are added
+    from BatchCreated events and whenever a lookup has to go to the database.
+    """
+
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self._skus: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._skus)
+
+    def get(self, batchref: str) -> Optional[str]:
+        with self._lock:
+            sku = self._skus.get(batchref)
+            if sku is not None:
+                self._skus.move_to_end(batchref)
+            return sku
+
+    def add(self, batchref: str, sku: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._skus[batchref] = sku
+            self._skus.move_to_end(batchref)
+            while len(self._skus) > self.max_entries:
+                self._skus.popitem(last=False)
+
+
+def load_options(strategy: str) -> list:
+    # how the batches and allocations of a product are loaded with it.
+    # "selectin" costs one query per relationship, "joined" a single query
+    # with a join per relationship, and "lazy" one query per batch on access
+    if strategy == "selectin":
+        return [
+            selectinload(model.Product.batches).selectinload(model.Batch.allocations)
+        ]
+    if strategy == "joined":
+        return [joinedload(model.Product.batches).joinedload(model.Batch.allocations)]
+    if strategy == "lazy":
+        return []
+    raise ValueError(f"Unknown load strategy {strategy}")
 
 
 class SqlAlchemyProductRepository(AbstractProductRepository):
     session: Session
+    load_strategy: str
+    cache: Optional[ProductCache]
+    batchrefs: Optional[BatchrefIndex]
 
-    def __init__(self, session: Session):
+    def __init__(
+        self,
+        session: Session,
+        load_strategy: str = "selectin",
+        cache: Optional[ProductCache] = None,
+        batchrefs: Optional[BatchrefIndex] = None,
+    ):
         super().__init__()
         self.session = session
+        self.load_strategy = load_strategy
+        self.cache = cache
+        self.batchrefs = batchrefs
+
+    def _query(self):
+        return self.session.query(model.Product).options(
+            *load_options(self.load_strategy)
+        )
 
     def _add(self, product: model.Product) -> None:
         self.session.add(product)
 
     def _get(self, sku: str) -> model.Product:
-        return self.session.query(model.Product).filter_by(sku=sku).one()
+        if self.cache is not None:
+            product = self._get_cached(self.cache, sku)
+            if product is not None:
+                return product
+        return self._query().filter_by(sku=sku).one()
 
-    def _get_by_batchref(self, batchref):
-        return (
-            self.session.query(model.Product)
-            .join(model.Batch)
-            .filter(orm.batches.c.reference == batchref)
-            .first()
+    def _get_cached(self, cache: ProductCache, sku: str) -> Optional[model.Product]:
+        product = cache.checkout(sku)
+        if product is None:
+            return None
+        version_number = self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar()
+        if version_number != product.version_number:
+            cache.record_stale()
+            return None
+        cache.record_hit()
+        # re-attaches the detached aggregate without emitting any SQL
+        self.session.add(product)
+        return product
+
+    def _get_many(self, skus: List[str]) -> List[model.Product]:
+        products = []
+        if self.cache is not None:
+            products = self._get_many_cached(self.cache, skus)
+            loaded = {product.sku for product in products}
+            skus = [sku for sku in skus if sku not in loaded]
+        if skus:
+            products.extend(self._query().filter(orm.products.c.sku.in_(skus)))
+        return products
+
+    def _get_many_cached(
+        self, cache: ProductCache, skus: List[str]
+    ) -> List[model.Product]:
+        cached = [cache.checkout(sku) for sku in skus]
+        products = {product.sku: product for product in cached if product is not None}
+        if not products:
+            return []
+        versions = dict(
+            self.session.execute(
+                select(orm.products.c.sku, orm.products.c.version_number).where(
+                    orm.products.c.sku.in_(list(products))
+                )
+            ).all()
         )
+        fresh = []
+        for sku, product in products.items():
+            if versions.get(sku) != product.version_number:
+                cache.record_stale()
+                continue
+            cache.record_hit()
+            self.session.add(product)
+            fresh.append(product)
+        return fresh
+
+    def release(self) -> None:
+        # returns the products of a committed session to the cache
+        if self.cache is not None:
+            for product in self.seen:
+                if not product.events:
+                    self.cache.checkin(product)
+
+    def _get_by_batchref(self, batchref):
+        sku = self.batchrefs.get(batchref) if self.batchrefs is not None else None
+        if sku is None:
+            sku = self.session.execute(
+                select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
+            ).scalar()
+            if sku is None:
+                return None
+            self.register_batchref(batchref, sku)
+        return self._get(sku)
+
+    def register_batchref(self, batchref: str, sku: str):
+        if self.batchrefs is not None:
+            self.batchrefs.add(batchref, sku)
 
     def list(self) -> List[model.Product]:
         return self.session.query(model.Product).all()
+
+    def stream(self, chunk_size: int = 1000) -> Iterator[model.Product]:
+        # joined eager loading of collections cannot be combined with yield_per
+        strategy = "selectin" if self.load_strategy == "joined" else self.load_strategy
+        return iter(
+            self.session.query(model.Product)
+            .options(*load_options(strategy))
+            .order_by(orm.products.c.id)
+            .yield_per(chunk_size)
+        )
@@ -1,20 +1,36 @@
 from dataclasses import dataclass
 from datetime import date
+from typing import List
 
 
 class Command:
-    pass
+    # no per-instance __dict__, subclasses declare their fields as slots
+    __slots__ = ()
 
 
 @dataclass
 class Allocate(Command):
+    __slots__ = ("orderid", "sku", "qty")
+
     orderid: str
     sku: str
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    """Allocates of one sku, applied in order in a single transaction."""
+
+    __slots__ = ("sku", "lines")
+
+    sku: str
+    lines: List[Allocate]
+
+
 @dataclass
 class CreateBatch(Command):
+    __slots__ = ("ref", "sku", "qty", "eta")
+
     ref: str
     sku: str
     qty: int
@@ -23,27 +39,35 @@ class CreateBatch(Command):
 
 @dataclass
 class ChangeBatchQuantity(Command):
+    __slots__ = ("ref", "qty")
+
     ref: str
     qty: int
 
 
 @dataclass
 class GetProducts(Command):
-    pass
+    __slots__ = ()
 
 
 @dataclass
 class CreateProduct(Command):
+    __slots__ = ("sku",)
+
     sku: str
 
 
 @dataclass
 class GetBatches(Command):
+    __slots__ = ("sku",)
+
     sku: str
 
 
 @dataclass
 class Deallocate(Command):
+    __slots__ = ("ref", "orderid", "sku", "qty")
+
     ref: str
     orderid: str
     sku: str
@@ -1,19 +1,24 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Union
+from typing import Optional
 
 
 class Event:
-    pass
+    # no per-instance __dict__, subclasses declare their fields as slots
+    __slots__ = ()
 
 
 @dataclass
 class OutOfStock(Event):
+    __slots__ = ("sku",)
+
     sku: str
 
 
 @dataclass
 class Allocated(Event):
+    __slots__ = ("orderid", "sku", "qty", "batchref")
+
     orderid: str
     sku: str
     qty: int
@@ -22,24 +27,43 @@ class Allocated(Event):
 
 @dataclass
 class Deallocated(Event):
+    __slots__ = ("orderid", "sku")
+
+    orderid: str
+    sku: str
+
+
+@dataclass
+class Reallocated(Event):
+    __slots__ = ("orderid", "sku", "qty", "batchref", "previous_batchref")
+
     orderid: str
     sku: str
+    qty: int
+    batchref: str
+    previous_batchref: str
 
 
 @dataclass
 class ProductCreated(Event):
+    __slots__ = ("sku",)
+
     sku: str
 
 
 @dataclass
 class BatchCreated(Event):
+    __slots__ = ("sku", "reference", "eta", "qty")
+
     sku: str
     reference: str
-    eta: Union[str, date]
+    eta: Optional[date]
     qty: int
 
 
 @dataclass
 class BatchQuantityChanged(Event):
+    __slots__ = ("ref", "qty")
+
     ref: str
     qty: int
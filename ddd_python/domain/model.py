@@ -1,6 +1,7 @@
+from bisect import bisect_left
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from . import commands, events
 
@@ -23,11 +24,73 @@ class OrderLine:
     qty: int
 
 
+class Allocations:
+    """Order lines allocated to a batch, keyed by (orderid, sku).
+
+    Keeps insertion order so the most recent allocation is popped first, and a
+    running total of the allocated quantity. Its append/remove/pop/__iter__ are
+    list-like so the ORM can use it as a relationship collection_class.
+    """
+
+    def __init__(self, lines: Iterable[OrderLine] = ()) -> None:
+        self._lines: Dict[Tuple[str, str], OrderLine] = {}
+        self.quantity = 0
+        for line in lines:
+            self.append(line)
+
+    @staticmethod
+    def _key(line: OrderLine) -> Tuple[str, str]:
+        return line.orderid, line.sku
+
+    def __iter__(self) -> Iterator[OrderLine]:
+        return iter(self._lines.values())
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __contains__(self, line) -> bool:
+        return self._key(line) in self._lines
+
+    def __getitem__(self, index: int) -> OrderLine:
+        # positional access is O(n), it is only here for list compatibility
+        return list(self._lines.values())[index]
+
+    def __eq__(self, other):
+        if isinstance(other, Allocations):
+            return list(self) == list(other)
+        return list(self) == other
+
+    def __repr__(self):
+        return f"Allocations({list(self)!r})"
+
+    def get(self, line: OrderLine) -> Optional[OrderLine]:
+        return self._lines.get(self._key(line))
+
+    def append(self, line: OrderLine) -> None:
+        key = self._key(line)
+        if key in self._lines:
+            return
+        self._lines[key] = line
+        self.quantity += line.qty
+
+    def remove(self, line: OrderLine) -> None:
+        removed = self._lines.pop(self._key(line))
+        self.quantity -= removed.qty
+
+    def pop(self, index: int = -1) -> OrderLine:
+        if index == -1:
+            _, line = self._lines.popitem()
+        else:
+            line = self._lines.pop(list(self._lines)[index])
+        self.quantity -= line.qty
+        return line
+
+
 class Batch:
     reference: str
     sku: str
     eta: date
-    allocations: List[OrderLine]
+    allocations: Allocations
     _purchased_quantity: int
 
     def __init__(self, ref: str, sku: str, qty: int, eta: date) -> None:
@@ -35,7 +98,7 @@ class Batch:
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
-        self.allocations = []
+        self.allocations = Allocations()
 
     def __eq__(self, other):
         if not isinstance(other, Batch):
@@ -61,7 +124,7 @@ class Batch:
 
     @property  # no setter means any setting will raise Exception
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self.allocations)
+        return self.allocations.quantity
 
     @property
     def available_quantity(self) -> int:
@@ -74,16 +137,15 @@ class Batch:
         return False
 
     def add_allocation(self, line: OrderLine):
-        allocations = set(self.allocations)
-        allocations.add(line)
-
-        self.allocations = list(allocations)
+        if line not in self.allocations:
+            self.allocations.append(line)
 
     def remove_allocation(self, line: OrderLine):
-        allocations = set(self.allocations)
-        allocations.remove(line)
-
-        self.allocations = list(allocations)
+        # remove the stored instance, the ORM tracks allocations by identity
+        allocated = self.allocations.get(line)
+        if allocated is None:
+            raise ValueError(f"{line} is not allocated to {self.reference}")
+        self.allocations.remove(allocated)
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
@@ -97,19 +159,70 @@ class Batch:
             self.remove_allocation(line)
 
     def deallocate_one(self) -> OrderLine:
+        # most recent allocation first
         return self.allocations.pop()
 
 
+BatchKey = Tuple[date, str]
+
+
+def batch_key(batch: Batch) -> BatchKey:
+    # batches without an eta are in stock, so they sort before any shipment
+    return (batch.eta or date.min, batch.reference)
+
+
+class AvailabilityTree:
+    """Max segment tree over the available quantities of ETA-ordered batches.
+
+    Finds the first batch able to take a quantity in O(log n), which is the
+    first-fit rule Product.allocate applies one line at a time.
+    """
+
+    def __init__(self, quantities: List[int]) -> None:
+        self._count = len(quantities)
+        self._size = 1
+        while self._size < len(quantities):
+            self._size *= 2
+        self._tree = [0] * (2 * self._size)
+        self._tree[self._size : self._size + len(quantities)] = quantities
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def first_fit(self, qty: int) -> Optional[int]:
+        if not self._count or self._tree[1] < qty:
+            return None
+        node = 1
+        while node < self._size:
+            node *= 2
+            if self._tree[node] < qty:
+                node += 1
+        return node - self._size
+
+    def update(self, position: int, qty: int) -> None:
+        node = position + self._size
+        self._tree[node] = qty
+        while node > 1:
+            node //= 2
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+
 # Aggregates
 class Product:
     sku: str
     batches: List[Batch]
     version_number: int
     events: Events
+    # batches by reference, and batches with stock left ordered by batch_key.
+    # built lazily because the ORM does not call __init__, and kept up to date
+    # by the methods below
+    _batches_by_ref: Optional[Dict[str, Batch]]
+    _open_batches: List[Tuple[BatchKey, Batch]]
 
     def __new__(cls, *args, **kwargs):
         instance = super(Product, cls).__new__(cls)
         instance.events = []
+        instance._batches_by_ref = None
+        instance._open_batches = []
         return instance
 
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
@@ -127,10 +240,40 @@ class Product:
     def __hash__(self):
         return hash(self.sku)
 
+    def invalidate_indexes(self) -> None:
+        # for when batches were reloaded, eg. after a rollback
+        self._batches_by_ref = None
+        self._open_batches = []
+
+    def _index(self) -> Dict[str, Batch]:
+        if self._batches_by_ref is None or len(self._batches_by_ref) != len(
+            self.batches
+        ):
+            self._batches_by_ref = {batch.reference: batch for batch in self.batches}
+            self._open_batches = sorted(
+                (batch_key(batch), batch)
+                for batch in self.batches
+                if batch.available_quantity > 0
+            )
+        return self._batches_by_ref
+
+    def _reindex(self, batch: Batch) -> None:
+        self._index()
+        open_batches = self._open_batches
+        key = batch_key(batch)
+        position = bisect_left(open_batches, (key,))
+        indexed = position < len(open_batches) and open_batches[position][0] == key
+        if batch.available_quantity > 0 and not indexed:
+            open_batches.insert(position, (key, batch))
+        elif batch.available_quantity <= 0 and indexed:
+            del open_batches[position]
+
     def allocate(self, line: OrderLine):
         try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
+            self._index()
+            batch = next(b for _, b in self._open_batches if b.can_allocate(line))
             batch.allocate(line)
+            self._reindex(batch)
             self.events.append(
                 events.Allocated(
                     orderid=line.orderid,
@@ -144,22 +287,71 @@ class Product:
         except StopIteration:
             self.events.append(events.OutOfStock(self.sku))
 
+    def _first_fit(self, lines: List[OrderLine]) -> List[Optional[Batch]]:
+        # allocates lines in order and returns the batch each one went to
+        self._index()
+        batches = [batch for _, batch in self._open_batches]
+        tree = AvailabilityTree([batch.available_quantity for batch in batches])
+        allocated_to: List[Optional[Batch]] = []
+        for line in lines:
+            position = tree.first_fit(line.qty) if line.sku == self.sku else None
+            if position is None:
+                allocated_to.append(None)
+                continue
+            batch = batches[position]
+            batch.allocate(line)
+            tree.update(position, batch.available_quantity)
+            allocated_to.append(batch)
+        self._open_batches = [
+            (batch_key(batch), batch)
+            for batch in batches
+            if batch.available_quantity > 0
+        ]
+        return allocated_to
+
+    def allocate_many(self, lines: List[OrderLine]) -> List[Optional[str]]:
+        """Allocate lines in order, as repeated calls to allocate would.
+
+        Returns the allocated batch reference (or None) for each line.
+        """
+        refs: List[Optional[str]] = []
+        for line, batch in zip(lines, self._first_fit(lines)):
+            if batch is None:
+                self.events.append(events.OutOfStock(self.sku))
+                refs.append(None)
+                continue
+            self.events.append(
+                events.Allocated(
+                    orderid=line.orderid,
+                    sku=line.sku,
+                    qty=line.qty,
+                    batchref=batch.reference,
+                )
+            )
+            self.version_number += 1
+            refs.append(batch.reference)
+        return refs
+
     def deallocate(self, ref: str, line: OrderLine):
-        batch = next(b for b in self.batches if b.reference == ref)
+        batch = self._index()[ref]
         batch.deallocate(line)
+        self._reindex(batch)
         self.version_number += 1
         self.events.append(events.Deallocated(orderid=line.orderid, sku=line.sku))
 
     def add_batches(self, batches: List[Batch]):
         today = date.today()
-        current_batches = set(self.batches)
         for batch in batches:
             if batch.sku != self.sku:
                 raise InvalidSku(f"{batch.sku} does not match {self.sku}")
             if batch.eta < today:
                 raise InvalidETA("ETA cannot be in the past")
-            current_batches.add(batch)
-        self.batches = list(current_batches)
+        batches_by_ref = self._index()
+        for batch in batches:
+            if batch.reference not in batches_by_ref:
+                batches_by_ref[batch.reference] = batch
+                self.batches.append(batch)
+                self._reindex(batch)
         self.events.extend(
             events.BatchCreated(
                 sku=batch.sku,
@@ -173,11 +365,35 @@ class Product:
         return [batch for batch in self.batches if not batch.has_allocations]
 
     def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+        batch = self._index()[ref]
         batch._purchased_quantity = qty
         self.events.append(events.BatchQuantityChanged(ref=ref, qty=qty))
         self.version_number += 1
+        displaced = []
         while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(events.Deallocated(orderid=line.orderid, sku=line.sku))
-            self.events.append(commands.Allocate(line.orderid, line.sku, line.qty))
+            displaced.append(batch.deallocate_one())
+        self._reindex(batch)
+        self._reallocate(batch, displaced)
+
+    def _reallocate(self, source: Batch, lines: List[OrderLine]):
+        # moves lines displaced from source to other batches in one pass, lines
+        # that fit back into source did not move and need no event
+        out_of_stock = False
+        for line, batch in zip(lines, self._first_fit(lines)):
+            if batch is None:
+                out_of_stock = True
+                self.events.append(
+                    events.Deallocated(orderid=line.orderid, sku=line.sku)
+                )
+            elif batch is not source:
+                self.events.append(
+                    events.Reallocated(
+                        orderid=line.orderid,
+                        sku=line.sku,
+                        qty=line.qty,
+                        batchref=batch.reference,
+                        previous_batchref=source.reference,
+                    )
+                )
+        if out_of_stock:
+            self.events.append(events.OutOfStock(self.sku))
@@ -0,0 +1,31 @@
+import sys
+
+from ddd_python.adapters import database, dead_letters, orm
+from ddd_python.service_layer import bootstrap, retries
+
+
+def show(store: dead_letters.AbstractDeadLetterStore):
+    for letter in store.list():
+        print(
+            f"{letter.id}\t{letter.handler}\t{letter.event}\t"
+            f"attempts={letter.attempts}\t{letter.error}"
+        )
+
+
+def replay(store: dead_letters.AbstractDeadLetterStore):
+    bus = bootstrap.MessageBus(bootstrap.build_uow())
+    # follow up handlers that fail go straight back to the store, nothing is
+    # left in memory when the command exits
+    bus.retries = retries.RetryScheduler(bus.retry_handler, store, max_attempts=1)
+    failed = retries.replay_dead_letters(store, bus.retry_handler, bus.find_handler)
+    for letter in failed:
+        print(f"{letter.id}\t{letter.handler}\tstill failing: {letter.error}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    orm.start_mappers()
+    store = dead_letters.SqlAlchemyDeadLetterStore(database.create_session)
+    if sys.argv[1:] == ["replay"]:
+        sys.exit(replay(store))
+    show(store)
@@ -1,11 +1,11 @@
 from datetime import datetime
 
-from flask import Flask, request
+from flask import Flask, Response, request
 
-from ddd_python.adapters import email, event_publisher, orm
-from ddd_python.config import redis_host, redis_port
+from ddd_python import metrics
+from ddd_python.adapters import orm
 from ddd_python.domain import commands
-from ddd_python.service_layer import bootstrap, unit_of_work, views
+from ddd_python.service_layer import bootstrap, views
 
 app = Flask(__name__)
 
@@ -16,7 +16,7 @@ orm.start_mappers()
 
 @app.route("/products", methods=["POST"])
 def add_products():
-    messagebus = bootstrap()
+    messagebus = bootstrap.bootstrap()
     results = messagebus.handle(commands.CreateProduct(request.json.get("sku")))
     productref = results.pop(0)
     return {"productref": productref}, 201
@@ -27,7 +27,7 @@ def add_products():
 
 @app.route("/batches", methods=["POST"])
 def add_batch():
-    messagebus = bootstrap()
+    messagebus = bootstrap.bootstrap()
     date = datetime.strptime(request.json.get("eta"), "%m/%d/%Y").date()
     results = messagebus.handle(
         commands.CreateBatch(
@@ -44,7 +44,7 @@ def add_batch():
 
 @app.route("/batches", methods=["PUT"])
 def change_batch_quantity():
-    messagebus = bootstrap()
+    messagebus = bootstrap.bootstrap()
     results = messagebus.handle(
         commands.ChangeBatchQuantity(request.json.get("ref"), request.json.get("qty"))
     )
@@ -57,7 +57,7 @@ def change_batch_quantity():
 
 @app.route("/allocate", methods=["POST"])
 def allocate_endpoint():
-    messagebus = bootstrap()
+    messagebus = bootstrap.bootstrap()
     results = messagebus.handle(
         commands.Allocate(
             request.json.get("orderid"),
@@ -71,7 +71,7 @@ def allocate_endpoint():
 
 @app.route("/deallocate", methods=["POST"])
 def deallocate():
-    messagebus = bootstrap()
+    messagebus = bootstrap.bootstrap()
     messagebus.handle(
         commands.Deallocate(
             request.json.get("ref"),
@@ -88,36 +88,29 @@ def deallocate():
 
 @app.route("/products", methods=["GET"])
 def products_view():
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
+    uow = bootstrap.build_uow()
     return {"products": views.products(uow)}
 
 
 @app.route("/products/<sku>/batches", methods=["GET"])
 def batches_view(sku):
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
+    uow = bootstrap.build_uow()
     return {"batches": views.batches(sku, uow)}
 
 
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view(orderid):
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
+    uow = bootstrap.build_uow()
     return {"allocations": views.allocations(orderid, uow)}
 
 
+# Metrics
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_view():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     app.run(port=5000)
@@ -0,0 +1,22 @@
+import logging
+import time
+
+from ddd_python import config
+from ddd_python.adapters import database, event_publisher, outbox
+
+if __name__ == "__main__":
+    relay = outbox.OutboxRelay(
+        database.create_session,
+        event_publisher.build_publisher(),
+        batch_size=config.outbox_batch_size,
+    )
+    while True:
+        try:
+            relayed = relay.relay_once()
+        except Exception as e:
+            # rows stay unsent and are picked up again once redis is back
+            logging.warning("outbox relay failed: %r", e)
+            relayed = 0
+        # a full batch means more rows are probably waiting
+        if relayed < relay.batch_size:
+            time.sleep(config.outbox_poll_interval)
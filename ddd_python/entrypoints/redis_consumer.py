@@ -1,120 +1,185 @@
-import json
-from datetime import datetime
-from typing import Callable, Dict, Optional
+import logging
+import os
+import socket
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Type
 
 from redis import Redis
+from redis.client import PubSub
 
-from ddd_python.adapters import email, event_publisher, orm
+from ddd_python import config, metrics
+from ddd_python.adapters import codec, redis_streams
 from ddd_python.config import redis_host, redis_port
 from ddd_python.domain import commands
-from ddd_python.service_layer import unit_of_work
-from ddd_python.service_layer.messagebus import MessageBus
+from ddd_python.service_layer import bootstrap
+from ddd_python.service_layer.messagebus import AbstractMessageBus
 
+logger = logging.getLogger(__name__)
 
-class RedisMessage:
-    channel: str
-    type: str
-    pattern: Optional[str]
-    data: Dict[str, str]
+CODEC = codec.get_codec(config.wire_codec)
 
-    def __init__(self, channel: str, message_type: str, pattern: str, data: str):
-        self.channel = channel
-        self.type = message_type
-        self.pattern = pattern
-        self.data = json.loads(data)
+# the command each channel carries
+COMMANDS: Dict[str, Type[commands.Command]] = {
+    "add_products": commands.CreateProduct,
+    "add_batch": commands.CreateBatch,
+    "change_batch_quantity": commands.ChangeBatchQuantity,
+    "allocate": commands.Allocate,
+    "deallocate": commands.Deallocate,
+}
 
+CHANNELS: List[str] = list(COMMANDS)
 
-# Products
 
+def decode_command(channel: str, data: bytes) -> Optional[commands.Command]:
+    """The command of a message, None for channels the consumer does not handle.
 
-def add_products(message: RedisMessage):
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
-    messagebus = MessageBus(uow)
-    messagebus.handle(commands.CreateProduct(message.data.get("sku", "")))
+    Raises codec.CodecError when the payload does not decode.
+    """
+    command_type = COMMANDS.get(channel)
+    if command_type is None:
+        return None
+    return CODEC.decode(data, command_type)
 
 
-# Batches
+def group_allocations(
+    messages: Iterable[commands.Command],
+) -> List[commands.Command]:
+    """Merges the allocates of each sku into one AllocateMany.
 
+    Lines keep their arrival order. Allocates are not moved past the other
+    commands, so an allocate still sees the batches that were added before it.
+    """
+    grouped: List[commands.Command] = []
+    allocates: Dict[str, List[commands.Allocate]] = {}
 
-def add_batch(message: RedisMessage):
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
-    messagebus = MessageBus(uow)
-    date = datetime.strptime(message.data.get("eta", ""), "%m/%d/%Y").date()
-    messagebus.handle(
-        commands.CreateBatch(
-            message.data.get("ref", ""),
-            message.data.get("sku", ""),
-            int(message.data.get("qty", 0)),
-            date,
+    def flush():
+        grouped.extend(
+            commands.AllocateMany(sku, lines) for sku, lines in allocates.items()
         )
-    )
-
-
-def change_batch_quantity(message: RedisMessage):
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
-    messagebus = MessageBus(uow)
-    messagebus.handle(
-        commands.ChangeBatchQuantity(
-            message.data.get("ref", ""), int(message.data.get("qty", 0))
+        allocates.clear()
+
+    for message in messages:
+        if isinstance(message, commands.Allocate):
+            allocates.setdefault(message.sku, []).append(message)
+        else:
+            flush()
+            grouped.append(message)
+    flush()
+    return grouped
+
+
+def handle_messages(
+    bus: AbstractMessageBus,
+    messages: Sequence[Tuple[str, bytes]],
+    group: bool = False,
+) -> List[int]:
+    """Handles (channel, data) messages in order on the worker's bus.
+
+    With group, the allocates of a sku load the product once and commit once.
+    A message that cannot be decoded or handled is logged and skipped, the
+    positions of those messages are returned.
+    """
+    failed: List[int] = []
+    decoded: List[commands.Command] = []
+    # the message each command came from, by identity
+    positions: Dict[int, int] = {}
+    for position, (channel, data) in enumerate(messages):
+        # whatever a payload holds, it must not stop the consumer
+        try:
+            command = decode_command(channel, data)
+        except Exception:
+            logger.exception("undecodable message on %s", channel)
+            failed.append(position)
+            continue
+        if command is not None:
+            positions[id(command)] = position
+            decoded.append(command)
+    if group:
+        decoded = group_allocations(decoded)
+    for handled in bus.handle_many(decoded):
+        if handled.error is None:
+            continue
+        logger.error(
+            "%s failed: %r", handled.message, handled.error, exc_info=handled.error
         )
+        if isinstance(handled.message, commands.AllocateMany):
+            failed.extend(positions[id(line)] for line in handled.message.lines)
+        else:
+            failed.append(positions[id(handled.message)])
+    return sorted(failed)
+
+
+def read_pubsub(
+    pubsub: PubSub, max_messages: int, max_wait: float
+) -> List[Tuple[str, bytes]]:
+    """Waits for a message, then takes those arriving within max_wait seconds."""
+    messages: List[Tuple[str, bytes]] = []
+    deadline = None
+    while len(messages) < max_messages:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+        # None as well for the subscribe confirmations. A timeout of None
+        # blocks, which redis-py supports but its stubs do not declare
+        message = pubsub.get_message(timeout=timeout)  # type: ignore[arg-type]
+        if message is None:
+            continue
+        if deadline is None:
+            deadline = time.monotonic() + max_wait
+        messages.append((message["channel"].decode(), message["data"]))
+    return messages
+
+
+def consume_pubsub(r: Redis, bus: AbstractMessageBus):
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*CHANNELS)
+    batch_size = config.consumer_batch_size
+    max_wait = config.consumer_batch_wait_ms / 1000
+    while True:
+        messages = read_pubsub(pubsub, batch_size, max_wait)
+        handle_messages(bus, messages, group=batch_size > 1)
+
+
+def consume_streams(r: Redis, bus: AbstractMessageBus):
+    # micro-batching reads its batches straight from XREADGROUP
+    group = config.consumer_batch_size > 1
+    consumer = redis_streams.StreamConsumer(
+        r,
+        config.stream_group,
+        f"{socket.gethostname()}-{os.getpid()}",
+        CHANNELS,
+        batch_size=config.consumer_batch_size if group else config.stream_batch_size,
+        block_ms=config.stream_block_ms,
+        claim_idle_ms=config.stream_claim_idle_ms,
+        max_deliveries=config.stream_max_deliveries,
     )
-
-
-# Allocations
-
-
-def allocate_endpoint(message: RedisMessage):
-    uow = unit_of_work.SqlAlchemyUnitOfWork(
-        email.FakeEmailAdapter(),
-        event_publisher=event_publisher.RedisPublisherAdapter(
-            host=redis_host, port=redis_port
-        ),
-    )
-    messagebus = MessageBus(uow)
-    messagebus.handle(
-        commands.Allocate(
-            message.data.get("orderid", ""),
-            message.data.get("sku", ""),
-            int(message.data.get("qty", 0)),
+    consumer.ensure_groups()
+    while True:
+        messages = consumer.read()
+        failed = set(
+            handle_messages(
+                bus, [(message.stream, message.data) for message in messages], group
+            )
         )
-    )
+        # failed entries stay pending and are claimed again once idle, until
+        # they run out of deliveries
+        consumer.ack(m for i, m in enumerate(messages) if i not in failed)
+        consumer.fail([m for i, m in enumerate(messages) if i in failed])
 
 
-ENTRYPOINTS: Dict[str, Callable] = {
-    "allocate": allocate_endpoint,
-    "add_products": add_products,
-    "add_batch": add_batch,
-    "change_batch_quantity": change_batch_quantity,
-}
-
 if __name__ == "__main__":
-    orm.start_mappers()
+    logging.basicConfig(level=logging.INFO)
+    # one bus for the life of the worker, its unit of work opens a session
+    # per message from the shared session factory and publishes through the
+    # shared redis pool
+    bus = bootstrap.bootstrap(start_orm=True)
+    if metrics.REGISTRY.enabled:
+        metrics.dump_periodically(config.metrics_dump_interval)
+    # a client of its own, blocking reads must not share the pool's timeouts
     r = Redis(host=redis_host, port=redis_port)
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe(
-        "allocate",
-        "add_products",
-        "add_batch",
-        "change_batch_quantity",
-    )
-
-    for message in pubsub.listen():
-        redis_message = RedisMessage(**message)
-        entry_point = ENTRYPOINTS.get(message["channel"])
-        if entry_point:
-            entry_point(redis_message)
+    if config.redis_transport == "streams":
+        consume_streams(r, bus)
+    else:
+        consume_pubsub(r, bus)
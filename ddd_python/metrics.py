@@ -0,0 +1,207 @@
+"""In-process metrics, rendered in the prometheus text format.
+
+Everything is a no-op unless the registry is enabled (METRICS_ENABLED), the
+hot path then pays for one attribute check per call site.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from ddd_python import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+LabelValues = Tuple[str, ...]
+# name, labels, value of a sample read when the registry is rendered
+Sample = Tuple[str, Dict[str, str], float]
+
+_NOOP = nullcontext()
+
+
+def _format_labels(labels: Mapping[str, object]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class Family:
+    kind = ""
+
+    def __init__(self, registry: "Registry", name: str, description: str, labels=()):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _labels(self, values: LabelValues, **extra) -> str:
+        return _format_labels({**dict(zip(self.label_names, values)), **extra})
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(Family):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._labels(labels)} {value}")
+        return lines
+
+
+class Histogram(Family):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # per label values: a count per bucket (the last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        if not self.registry.enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels) or self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def time(self, *labels: str) -> ContextManager:
+        """Observes how long the with block took."""
+        if not self.registry.enabled:
+            return _NOOP
+        return self._time(labels)
+
+    @contextmanager
+    def _time(self, labels: LabelValues) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        values = self._values.get(labels)
+        return sum(values[0]) if values else 0
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = self._labels(labels, le=bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {total[0]}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+F = TypeVar("F", bound=Family)
+
+
+class Registry:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._families: Dict[str, Family] = {}
+        self._collectors: List[Callable[[], List[Sample]]] = []
+
+    def _register(self, family: F) -> F:
+        registered = self._families.setdefault(family.name, family)
+        if not isinstance(registered, type(family)):
+            raise ValueError(f"{family.name} is already a {registered.kind}")
+        return registered
+
+    def counter(self, name: str, description: str, labels=()) -> Counter:
+        return self._register(Counter(self, name, description, labels))
+
+    def histogram(
+        self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(
+            Histogram(self, name, description, labels, buckets=buckets)
+        )
+
+    def add_collector(self, collector: Callable[[], List[Sample]]):
+        """Adds gauges that are read when the registry is rendered."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for family in self._families.values():
+            lines.extend(family.render())
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(enabled=config.metrics_enabled)
+
+
+def dump_periodically(
+    interval: float, write: Callable[[str], None] = logger.info
+) -> threading.Thread:
+    """Writes the rendered registry every interval seconds from a daemon thread."""
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            write(REGISTRY.render())
+
+    thread = threading.Thread(target=loop, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
@@ -1,8 +1,68 @@
-from ddd_python.adapters import email, event_publisher, orm
-from ddd_python.config import redis_host, redis_port
+import os
+import threading
+from typing import Optional
+
+from ddd_python import config
+from ddd_python.adapters import database, dead_letters, email, event_publisher, orm
 
 from . import unit_of_work
 from .messagebus import MessageBus
+from .retries import RetryScheduler
+
+
+def build_uow(testing=False) -> unit_of_work.AbstractUnitOfWork:
+    if testing:
+        return unit_of_work.FakeUnitOfWork(
+            email.FakeEmailAdapter(),
+            event_publisher=event_publisher.FakePublisherAdapter(),
+        )
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        email.FakeEmailAdapter(),
+        event_publisher=event_publisher.build_publisher(),
+    )
+
+
+def build_retry_scheduler(
+    bus: MessageBus, store: dead_letters.AbstractDeadLetterStore
+) -> RetryScheduler:
+    retries = RetryScheduler(
+        bus.retry_handler,
+        store,
+        max_attempts=config.event_retry_attempts,
+        base_delay=config.event_retry_base_delay,
+        max_delay=config.event_retry_max_delay,
+    )
+    bus.retries = retries
+    return retries
+
+
+_retries: Optional[RetryScheduler] = None
+_lock = threading.Lock()
+
+
+def get_retry_scheduler() -> RetryScheduler:
+    # one scheduler per process, its worker thread runs the retries on a bus
+    # and unit of work of its own
+    global _retries
+    with _lock:
+        if _retries is None:
+            _retries = build_retry_scheduler(
+                MessageBus(build_uow()),
+                dead_letters.SqlAlchemyDeadLetterStore(database.create_session),
+            )
+            _retries.start()
+    return _retries
+
+
+def _after_fork_in_child() -> None:
+    # the worker thread does not survive a fork, the child starts its own
+    global _retries, _lock
+    _retries = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
 
 def bootstrap(
@@ -12,17 +72,10 @@ def bootstrap(
     if start_orm:
         orm.start_mappers()
 
+    bus = MessageBus(build_uow(testing))
     if testing:
-        uow = unit_of_work.FakeUnitOfWork(
-            email.FakeEmailAdapter(),
-            event_publisher=event_publisher.FakePublisherAdapter(),
-        )
+        # retries are only run when a test calls bus.retries.run_pending()
+        build_retry_scheduler(bus, dead_letters.FakeDeadLetterStore())
     else:
-        uow = unit_of_work.SqlAlchemyUnitOfWork(
-            email.FakeEmailAdapter(),
-            event_publisher=event_publisher.RedisPublisherAdapter(
-                host=redis_host, port=redis_port
-            ),
-        )
-
-    return MessageBus(uow)
+        bus.retries = get_retry_scheduler()
+    return bus
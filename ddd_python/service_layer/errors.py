@@ -4,3 +4,7 @@ class InvalidSku(Exception):
 
 class InvalidBatchRef(Exception):
     pass
+
+
+class ConcurrencyConflict(Exception):
+    pass
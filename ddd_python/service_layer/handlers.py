@@ -1,12 +1,11 @@
-from datetime import date
-from typing import List, Optional, Union
+from typing import Deque, List, Optional, Union
 
 from ddd_python.domain import commands, events, model
 
 from . import errors, unit_of_work
 
 Message = Union[commands.Command, events.Event]
-Messages = List[Message]
+Messages = Deque[Message]
 
 # COMMANDS
 
@@ -25,6 +24,22 @@ def allocate(
         raise errors.InvalidSku(f"Invalid sku {command.sku}")
 
 
+def allocate_many(
+    command: commands.AllocateMany,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    lines = [
+        model.OrderLine(line.orderid, line.sku, line.qty) for line in command.lines
+    ]
+    with uow:
+        product = uow.products.get(command.sku)
+        if product:
+            batch_refs = product.allocate_many(lines)
+            uow.commit()
+            return batch_refs
+        raise errors.InvalidSku(f"Invalid sku {command.sku}")
+
+
 def add_product(
     command: commands.CreateProduct,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -82,36 +97,12 @@ def send_out_of_stock_notification(
     )
 
 
-def publish_allocated_event(
-    event: events.Allocated,
-    uow: unit_of_work.AbstractUnitOfWork,
-    queue: Optional[Messages],
-):
-    uow.event_publisher.publish("line_allocated", event)
-
-
-def publish_deallocated_event(
-    event: events.Allocated,
-    uow: unit_of_work.AbstractUnitOfWork,
-    queue: Optional[Messages],
-):
-    uow.event_publisher.publish("line_deallocated", event)
-
-
 def add_allocation_to_read_model(
     event: events.Allocated,
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    with uow:
-        uow.execute(
-            """
-            INSERT INTO allocations_view (orderid, sku, batchref)
-            VALUES (:orderid, :sku, :batchref)
-            """,
-            {"orderid": event.orderid, "sku": event.sku, "batchref": event.batchref},
-        )
-        uow.commit()
+    uow.projections.insert_allocation(event.orderid, event.sku, event.batchref)
 
 
 def remove_allocation_from_read_model(
@@ -119,23 +110,15 @@ def remove_allocation_from_read_model(
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    with uow:
-        uow.execute(
-            """
-            DELETE FROM allocations_view
-            WHERE orderid = :orderid AND sku = :sku
-            """,
-            {"orderid": event.orderid, "sku": event.sku},
-        )
-        uow.commit()
+    uow.projections.remove_allocation(event.orderid, event.sku)
 
 
-def publish_product_created_event(
-    event: events.ProductCreated,
+def update_allocation_in_read_model(
+    event: events.Reallocated,
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    uow.event_publisher.publish("product_created", event)
+    uow.projections.update_allocation(event.orderid, event.sku, event.batchref)
 
 
 def add_product_to_read_model(
@@ -143,25 +126,16 @@ def add_product_to_read_model(
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    with uow:
-        uow.execute(
-            """
-            INSERT INTO products_view (sku)
-            VALUES (:sku)
-            """,
-            {"sku": event.sku},
-        )
-        uow.commit()
+    uow.projections.insert_product(event.sku)
 
 
-def publish_batch_created_event(
+def add_batch_to_batchref_index(
     event: events.BatchCreated,
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    if isinstance(event.eta, date):
-        event.eta = event.eta.strftime("%m/%d/%Y")
-    uow.event_publisher.publish("batch_created", event)
+    # an in memory index, no transaction needed
+    uow.register_batchref(event.reference, event.sku)
 
 
 def add_batch_to_read_model(
@@ -169,28 +143,7 @@ def add_batch_to_read_model(
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    with uow:
-        uow.execute(
-            """
-            INSERT INTO batches_view (sku, reference, eta, qty)
-            VALUES (:sku, :reference, :eta, :qty)
-            """,
-            {
-                "sku": event.sku,
-                "reference": event.reference,
-                "eta": event.eta,
-                "qty": event.qty,
-            },
-        )
-        uow.commit()
-
-
-def publish_batch_quantity_changed(
-    event: events.BatchQuantityChanged,
-    uow: unit_of_work.AbstractUnitOfWork,
-    queue: Optional[Messages],
-):
-    uow.event_publisher.publish("batch_quantity_changed", event)
+    uow.projections.insert_batch(event.sku, event.reference, event.eta, event.qty)
 
 
 def edit_batch_qty_to_read_model(
@@ -198,13 +151,4 @@ def edit_batch_qty_to_read_model(
     uow: unit_of_work.AbstractUnitOfWork,
     queue: Optional[Messages],
 ):
-    with uow:
-        uow.execute(
-            """
-            UPDATE batches_view
-            SET qty = :qty
-            WHERE reference = :ref
-            """,
-            {"ref": event.ref, "qty": event.qty},
-        )
-        uow.commit()
+    uow.projections.update_batch_qty(event.ref, event.qty)
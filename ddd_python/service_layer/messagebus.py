@@ -1,55 +1,141 @@
-from typing import Callable, Dict, List, Type, Union
-
-from retry import retry
-
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Type, Union
+
+from ddd_python import metrics
 from ddd_python.domain import commands, events
 
-from . import handlers, unit_of_work
+from . import errors, handlers, unit_of_work
+from .retries import RetryScheduler
+
+logger = logging.getLogger(__name__)
+
+COMMAND_SECONDS = metrics.REGISTRY.histogram(
+    "bus_command_seconds", "Time to handle a command, retries included", ["command"]
+)
+HANDLER_SECONDS = metrics.REGISTRY.histogram(
+    "bus_event_handler_seconds", "Time an event handler took", ["handler"]
+)
+QUEUE_DEPTH = metrics.REGISTRY.histogram(
+    "bus_queue_depth",
+    "Most messages queued at once during a handle call",
+    buckets=metrics.SIZE_BUCKETS,
+)
+COMMAND_RETRIES = metrics.REGISTRY.counter(
+    "bus_command_retries_total", "Commands retried after a conflict", ["command"]
+)
+COMMAND_FAILURES = metrics.REGISTRY.counter(
+    "bus_command_failures_total", "Commands that raised", ["command"]
+)
+HANDLER_FAILURES = metrics.REGISTRY.counter(
+    "bus_event_handler_failures_total", "Event handlers that raised", ["handler"]
+)
 
 Message = Union[commands.Command, events.Event]
 
 
+@dataclass
+class HandleResult:
+    message: Message
+    results: List[Any] = field(default_factory=list)
+    error: Optional[Exception] = None
+
+
 class AbstractMessageBus:
     EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]]
     COMMAND_HANDLERS: Dict[Type[commands.Command], Callable]
     uow: unit_of_work.AbstractUnitOfWork
-    queue: List[Message]
-
-    def __init__(self, uow: unit_of_work.AbstractUnitOfWork):
+    queue: Deque[Message]
+    retries: Optional[RetryScheduler]
+    # commands that lose an optimistic concurrency race are retried after a
+    # jittered, exponentially growing delay
+    COMMAND_ATTEMPTS = 5
+    RETRY_BASE_DELAY = 0.01
+    RETRY_MAX_DELAY = 0.5
+
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        retries: Optional[RetryScheduler] = None,
+    ):
         self.uow = uow
-        self.queue = []
+        self.queue = deque()
+        self.retries = retries
+
+    def _run_event_handler(self, event: events.Event, handler: Callable):
+        with HANDLER_SECONDS.time(handler.__name__):
+            handler(event, uow=self.uow, queue=self.queue)
+        self.queue.extend(self.uow.collect_new_events())
+
+    def _handler_failed(self, event: events.Event, handler: Callable, error: Exception):
+        # the handler's work was rolled back, it is retried later by the
+        # scheduler so the caller never waits on it
+        logger.warning("%s failed for %s: %r", handler.__name__, event, error)
+        HANDLER_FAILURES.inc(handler.__name__)
+        if self.retries is not None:
+            self.retries.schedule(event, handler, error)
 
     def _handle_event(self, event: events.Event):
         for handler in self.EVENT_HANDLERS[type(event)]:
             try:
-
-                @retry(tries=3, delay=2, backoff=1)
-                def run():
-                    handler(event, uow=self.uow, queue=self.queue)
-                    self.queue.extend(self.uow.collect_new_events())
-
-                run()
-
-            except Exception:
-                continue
+                self._run_event_handler(event, handler)
+            except Exception as e:
+                self.uow.discard_new_events()
+                self._handler_failed(event, handler, e)
 
     def _handle_command(
         self,
         command: commands.Command,
     ):
+        handler = self.COMMAND_HANDLERS[type(command)]
+        name = type(command).__name__
         try:
-            handler = self.COMMAND_HANDLERS[type(command)]
-            result = handler(command, uow=self.uow)
-            self.queue.extend(self.uow.collect_new_events())
-            return result
+            with COMMAND_SECONDS.time(name):
+                result = self._run_command_handler(command, handler)
         except Exception:
+            COMMAND_FAILURES.inc(name)
             raise
+        self.queue.extend(self.uow.collect_new_events())
+        return result
+
+    def _run_command_handler(self, command: commands.Command, handler: Callable):
+        attempt = 1
+        while True:
+            try:
+                return handler(command, uow=self.uow)
+            except errors.ConcurrencyConflict:
+                self.uow.discard_new_events()
+                if attempt >= self.COMMAND_ATTEMPTS:
+                    raise
+                COMMAND_RETRIES.inc(type(command).__name__)
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+
+    def _retry_delay(self, attempt: int) -> float:
+        # full jitter, so racing workers spread out instead of colliding again
+        ceiling = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2**attempt)
+        return random.uniform(0, ceiling)
 
     def handle(self, message: Message):
+        self.queue = deque([message])
+        try:
+            return self._drain()
+        finally:
+            self._end_cycle()
+
+    def _end_cycle(self):
+        # read model changes of the whole cycle are written together
+        self.uow.projections.flush_if_due()
+
+    def _drain(self) -> List[Any]:
         results = []
-        self.queue = [message]
+        depth = 0
         while self.queue:
-            message = self.queue.pop(0)
+            depth = max(depth, len(self.queue))
+            message = self.queue.popleft()
             if isinstance(message, events.Event):
                 self._handle_event(message)
             elif isinstance(message, commands.Command):
@@ -57,8 +143,58 @@ class AbstractMessageBus:
                 results.append(cmd_result)
             else:
                 raise Exception(f"{message} was not an Event or Command")
+        QUEUE_DEPTH.observe(depth)
         return results
 
+    def retry_handler(self, event: events.Event, handler: Callable):
+        """Runs one handler of an event again, then the messages it raised.
+
+        Errors of the handler itself propagate, so the scheduler can back off.
+        """
+        self.queue = deque()
+        try:
+            self._run_event_handler(event, handler)
+        except Exception:
+            self.uow.discard_new_events()
+            raise
+        try:
+            self._drain()
+        finally:
+            self._end_cycle()
+
+    def find_handler(self, event: events.Event, name: str) -> Callable:
+        for handler in self.EVENT_HANDLERS[type(event)]:
+            if handler.__name__ == name:
+                return handler
+        raise LookupError(f"{name} does not handle {type(event).__name__}")
+
+    def handle_many(self, messages: Iterable[Message]) -> List[HandleResult]:
+        """Handles a stream of root messages, one after the other.
+
+        A message that fails does not stop the others, its error is reported
+        in its HandleResult.
+        """
+        handled = []
+        for message in messages:
+            try:
+                handled.append(HandleResult(message, self.handle(message)))
+            except Exception as e:
+                self.uow.discard_new_events()
+                handled.append(HandleResult(message, error=e))
+        return handled
+
+    def handle_batch(self, messages: Iterable[Message]) -> List[HandleResult]:
+        """handle_many, with every message and its follow ups in one transaction.
+
+        A message that fails is rolled back on its own, the others commit
+        together at the end.
+        """
+        with self.uow.batch():
+            handled = self.handle_many(messages)
+        # the read model changes of the batch were held until it committed
+        self._end_cycle()
+        return handled
+
 
 class MessageBus(AbstractMessageBus):
     COMMAND_HANDLERS: Dict[Type[commands.Command], Callable] = {
@@ -66,29 +202,19 @@ class MessageBus(AbstractMessageBus):
         commands.CreateBatch: handlers.add_batch,
         commands.ChangeBatchQuantity: handlers.change_batch_quantity,
         commands.Allocate: handlers.allocate,
+        commands.AllocateMany: handlers.allocate_many,
         commands.Deallocate: handlers.deallocate,
     }
     EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]] = {
-        events.Allocated: [
-            handlers.publish_allocated_event,
-            handlers.add_allocation_to_read_model,
-        ],
-        events.Deallocated: [
-            handlers.publish_deallocated_event,
-            handlers.remove_allocation_from_read_model,
-        ],
-        events.ProductCreated: [
-            handlers.publish_product_created_event,
-            handlers.add_product_to_read_model,
-        ],
+        events.Allocated: [handlers.add_allocation_to_read_model],
+        events.Deallocated: [handlers.remove_allocation_from_read_model],
+        events.Reallocated: [handlers.update_allocation_in_read_model],
+        events.ProductCreated: [handlers.add_product_to_read_model],
         events.BatchCreated: [
-            handlers.publish_batch_created_event,
             handlers.add_batch_to_read_model,
+            handlers.add_batch_to_batchref_index,
         ],
-        events.BatchQuantityChanged: [
-            handlers.publish_batch_quantity_changed,
-            handlers.edit_batch_qty_to_read_model,
-        ],
+        events.BatchQuantityChanged: [handlers.edit_batch_qty_to_read_model],
         events.OutOfStock: [handlers.send_out_of_stock_notification],
     }
 
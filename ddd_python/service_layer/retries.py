@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+from ddd_python import metrics
+from ddd_python.adapters.dead_letters import AbstractDeadLetterStore, DeadLetter
+from ddd_python.domain import events
+
+logger = logging.getLogger(__name__)
+
+Dispatch = Callable[[events.Event, Callable], None]
+
+RETRIES = metrics.REGISTRY.counter(
+    "event_handler_retries_total", "Event handlers run again", ["handler"]
+)
+DEAD_LETTERS = metrics.REGISTRY.counter(
+    "event_handler_dead_letters_total", "Event handlers given up on", ["handler"]
+)
+
+
+@dataclass
+class RetryJob:
+    event: events.Event
+    handler: Callable
+    attempts: int
+    error: str = field(default="")
+
+
+class RetryScheduler:
+    """Retries failed event handlers later, off the request path.
+
+    Jobs wait in a heap ordered by due time, a failed attempt is rescheduled
+    with an exponentially growing delay and once max_attempts have failed the
+    job is written to the dead letter store.
+    """
+
+    def __init__(
+        self,
+        dispatch: Dispatch,
+        dead_letters: AbstractDeadLetterStore,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.dispatch = dispatch
+        self.dead_letters = dead_letters
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self._jobs: List[Tuple[float, int, RetryJob]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def delay(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+
+    def schedule(
+        self,
+        event: events.Event,
+        handler: Callable,
+        error: Exception,
+        attempts: int = 1,
+    ):
+        """Records a failed attempt, never blocks the caller."""
+        job = RetryJob(event, handler, attempts, repr(error))
+        if attempts >= self.max_attempts:
+            self._dead_letter(job)
+            return
+        due = self.clock() + self.delay(attempts)
+        with self._condition:
+            heapq.heappush(self._jobs, (due, next(self._sequence), job))
+            self._condition.notify()
+
+    def _dead_letter(self, job: RetryJob):
+        DEAD_LETTERS.inc(job.handler.__name__)
+        logger.error(
+            "giving up on %s for %s after %s attempts: %s",
+            job.handler.__name__,
+            job.event,
+            job.attempts,
+            job.error,
+        )
+        # the store is usually the database that just failed the handler, the
+        # worker thread has to outlive it
+        try:
+            self.dead_letters.add(
+                DeadLetter(job.handler.__name__, job.event, job.error, job.attempts)
+            )
+        except Exception:
+            logger.exception(
+                "could not dead letter %s for %s", job.handler.__name__, job.event
+            )
+
+    def _pop_due(self, now: float) -> Optional[RetryJob]:
+        with self._condition:
+            if self._jobs and self._jobs[0][0] <= now:
+                return heapq.heappop(self._jobs)[2]
+        return None
+
+    def _run(self, job: RetryJob):
+        RETRIES.inc(job.handler.__name__)
+        try:
+            self.dispatch(job.event, job.handler)
+        except Exception as e:
+            self.schedule(job.event, job.handler, e, job.attempts + 1)
+
+    def _run_safely(self, job: RetryJob):
+        # an error of one job must not end the worker thread
+        try:
+            self._run(job)
+        except Exception:
+            logger.exception(
+                "retry of %s for %s failed", job.handler.__name__, job.event
+            )
+
+    def run_pending(self, now: Optional[float] = None) -> int:
+        """Runs every job that is due, returns how many were run."""
+        now = self.clock() if now is None else now
+        ran = 0
+        while True:
+            job = self._pop_due(now)
+            if job is None:
+                return ran
+            self._run_safely(job)
+            ran += 1
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._stopping and (
+                    not self._jobs or self._jobs[0][0] > self.clock()
+                ):
+                    timeout = self._jobs[0][0] - self.clock() if self._jobs else None
+                    self._condition.wait(timeout)
+                if self._stopping:
+                    return
+            self.run_pending()
+
+    def start(self):
+        with self._condition:
+            if self._worker is not None:
+                return
+            self._stopping = False
+            self._worker = threading.Thread(
+                target=self._loop, name="event-retries", daemon=True
+            )
+        self._worker.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        with self._condition:
+            worker, self._worker = self._worker, None
+            self._stopping = True
+            self._condition.notify_all()
+        if worker is not None:
+            worker.join(timeout)
+
+
+def replay_dead_letters(
+    dead_letters: AbstractDeadLetterStore,
+    dispatch: Dispatch,
+    find_handler: Callable[[events.Event, str], Callable],
+) -> List[DeadLetter]:
+    """Runs every dead lettered handler again, returns the ones that still fail.
+
+    Letters that succeed are removed from the store.
+    """
+    failed = []
+    for letter in dead_letters.list():
+        try:
+            dispatch(letter.event, find_handler(letter.event, letter.handler))
+        except Exception as e:
+            logger.exception("replay of dead letter %s failed", letter.id)
+            letter.error = repr(e)
+            failed.append(letter)
+            continue
+        if letter.id is not None:
+            dead_letters.remove(letter.id)
+    return failed
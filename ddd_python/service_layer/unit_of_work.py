@@ -1,28 +1,49 @@
+import weakref
 from abc import ABC, abstractmethod
-from datetime import date
-from typing import Dict, List, Optional, Union
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Callable, Dict, Iterator, List, MutableMapping, Optional, Union
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, SessionTransaction
+from sqlalchemy.orm.exc import StaleDataError
 
-from ddd_python import config
-from ddd_python.adapters import repository
+from ddd_python import config, metrics
+from ddd_python.adapters import database, orm, outbox, repository
 from ddd_python.adapters.email import AbstractEmailAdapter
 from ddd_python.adapters.event_publisher import AbstractPublisherAdapter
+from ddd_python.adapters.projections import (
+    AbstractProjectionWriter,
+    FakeProjectionWriter,
+    HeldProjectionWriter,
+    SqlAlchemyProjectionWriter,
+)
+from ddd_python.domain import commands, events
+
+from . import errors
 
 Payload = Optional[Dict[str, Union[str, date, int]]]
 
+# serialization_failure and deadlock_detected
+CONFLICT_PGCODES = {"40001", "40P01"}
+
 
 class AbstractUnitOfWork(ABC):
     products: repository.AbstractProductRepository
     email: AbstractEmailAdapter
     event_publisher: AbstractPublisherAdapter
+    projections: AbstractProjectionWriter
 
     def __init__(
-        self, email: AbstractEmailAdapter, event_publisher: AbstractPublisherAdapter
+        self,
+        email: AbstractEmailAdapter,
+        event_publisher: AbstractPublisherAdapter,
+        projections: AbstractProjectionWriter,
     ):
         self.email = email
         self.event_publisher = event_publisher
+        self.projections = projections
 
     def __enter__(self):
         return self
@@ -30,77 +51,278 @@ class AbstractUnitOfWork(ABC):
     def __exit__(self, *args):
         self.rollback()
 
+    @contextmanager
+    def batch(self) -> Iterator["AbstractUnitOfWork"]:
+        """Runs every `with uow` block opened inside it in a single transaction.
+
+        Each block gets a savepoint, so a block that fails or is not committed
+        only rolls back its own changes. The transaction commits once at the end.
+        """
+        yield self
+
     @abstractmethod
     def rollback(self):
         raise NotImplementedError
 
-    @abstractmethod
     def commit(self):
+        # events go into the outbox in the same transaction as the aggregates
+        # that raised them, the outbox relay publishes them afterwards
+        self._add_to_outbox(outbox.to_messages(self._pending_events()))
+        self._commit()
+
+    @abstractmethod
+    def _commit(self):
         raise NotImplementedError
 
+    @abstractmethod
+    def _add_to_outbox(self, messages: List[outbox.OutboxMessage]):
+        raise NotImplementedError
+
+    def _pending_events(self) -> Iterator[Union[commands.Command, events.Event]]:
+        for product in self.products.seen:
+            yield from product.events
+
     @abstractmethod
     def execute(self, query: str, payload: Payload = None):
         raise NotImplementedError
 
+    @abstractmethod
+    def register_batchref(self, batchref: str, sku: str):
+        """Records the product a batch belongs to, outside of any transaction."""
+        raise NotImplementedError
+
     def collect_new_events(self):
         for product in self.products.seen:
-            while product.events:
+            if product.events:
+                # hand the whole list over instead of popping events one by one
+                new_events, product.events = product.events, []
                 # we return an iterator because much easier than returning an iterable
                 # all iterators are iterables
                 # not all iterables are iterators
-                yield product.events.pop(0)
+                yield from new_events
+
+    def discard_new_events(self):
+        # drops the events of an attempt that was rolled back
+        products = getattr(self, "products", None)  # nothing may be loaded yet
+        for product in products.seen if products else ():
+            product.events.clear()
 
 
 class FakeUnitOfWork(AbstractUnitOfWork):
     queries: List[str]
+    # what commit() added to the outbox
+    outboxed: List[outbox.OutboxMessage]
 
     def __init__(
-        self, email: AbstractEmailAdapter, event_publisher: AbstractPublisherAdapter
+        self,
+        email: AbstractEmailAdapter,
+        event_publisher: AbstractPublisherAdapter,
+        projections: Optional[AbstractProjectionWriter] = None,
     ):
-        super().__init__(email, event_publisher)
+        super().__init__(email, event_publisher, projections or FakeProjectionWriter())
         self.products = repository.FakeProductRepository([])
         self.committed = False
         self.queries = []
+        self.outboxed = []
 
-    def commit(self):
+    def _commit(self):
         self.committed = True
 
+    def _add_to_outbox(self, messages: List[outbox.OutboxMessage]):
+        self.outboxed.extend(messages)
+
     def rollback(self):
         pass
 
     def execute(self, query: str, payload: Payload = None):
         self.queries.append(query)
 
+    def register_batchref(self, batchref: str, sku: str):
+        self.products.register_batchref(batchref, sku)
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.postgres_uri, isolation_level="REPEATABLE READ", echo=False
-    )
+
+UOW_SQL_STATEMENTS = metrics.REGISTRY.histogram(
+    "uow_sql_statements",
+    "Statements run by one unit of work",
+    buckets=metrics.SIZE_BUCKETS,
+)
+UOW_SQL_SECONDS = metrics.REGISTRY.histogram(
+    "uow_sql_seconds", "Time spent running the statements of one unit of work"
 )
 
+PRODUCT_CACHE = repository.ProductCache(config.product_cache_size)
+BATCHREF_INDEX = repository.BatchrefIndex(config.batchref_index_size)
+# writers are dropped with their session factory
+_PROJECTION_WRITERS: MutableMapping[Callable, SqlAlchemyProjectionWriter] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def projection_writer(
+    session_factory: Callable[[], Session],
+) -> SqlAlchemyProjectionWriter:
+    """The process's read model writer for the database of session_factory.
+
+    Units of work share it, so their changes are buffered and written together.
+    """
+    writer = _PROJECTION_WRITERS.get(session_factory)
+    if writer is None:
+        writer = _PROJECTION_WRITERS.setdefault(
+            session_factory,
+            SqlAlchemyProjectionWriter(
+                session_factory,
+                flush_interval=config.projection_flush_interval,
+                max_pending=config.projection_max_pending,
+                max_failed=config.projection_max_failed,
+            ),
+        )
+    return writer
+
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
+    products: repository.SqlAlchemyProductRepository
+    cache: Optional[repository.ProductCache]
+
     def __init__(
         self,
         email: AbstractEmailAdapter,
         event_publisher: AbstractPublisherAdapter,
-        session_factory=DEFAULT_SESSION_FACTORY,
+        session_factory: Callable[[], Session] = database.create_session,
+        load_strategy: str = config.product_load_strategy,
+        cache: Optional[repository.ProductCache] = PRODUCT_CACHE,
+        batchrefs: Optional[repository.BatchrefIndex] = BATCHREF_INDEX,
+        projections: Optional[AbstractProjectionWriter] = None,
     ):
-        super().__init__(email, event_publisher)
+        super().__init__(
+            email, event_publisher, projections or projection_writer(session_factory)
+        )
         self.session_factory = session_factory
+        self.load_strategy = load_strategy
+        self.cache = cache
+        self.batchrefs = batchrefs
+        self._committed = False
+        self._cacheable = False
+        self._savepoint: Optional[SessionTransaction] = None
+        self._batching = False
 
-    def __enter__(self):
+    def _open_session(self):
+        if metrics.REGISTRY.enabled:
+            database.start_sql_stats()
         self.session = self.session_factory()
-        self.products = repository.SqlAlchemyProductRepository(self.session)
+        self.products = repository.SqlAlchemyProductRepository(
+            self.session,
+            load_strategy=self.load_strategy,
+            cache=self.cache,
+            batchrefs=self.batchrefs,
+        )
+        self._committed = False
+        self._cacheable = False
+
+    def __enter__(self):
+        if self._batching:
+            self._savepoint = self.session.begin_nested()
+            return
+        self._open_session()
 
     def __exit__(self, *args):
-        self.session.close()
+        if self._batching:
+            if self._savepoint.is_active:
+                self._savepoint.rollback()
+            return
+        session = self.session
+        # only aggregates whose every change was committed may be cached
+        self._cacheable = (
+            self._committed
+            and not session.in_transaction()
+            and not (session.new or session.dirty or session.deleted)
+        )
+        session.close()
+        if metrics.REGISTRY.enabled:
+            self._observe_sql()
 
-    def commit(self):
-        self.session.commit()
+    def _observe_sql(self):
+        stats = database.stop_sql_stats()
+        if stats is not None:
+            UOW_SQL_STATEMENTS.observe(stats[0])
+            UOW_SQL_SECONDS.observe(stats[1])
+
+    @contextmanager
+    def batch(self) -> Iterator["SqlAlchemyUnitOfWork"]:
+        # read model changes wait for the batch's commit, they are dropped if
+        # it never happens
+        projections = self.projections
+        held = self.projections = HeldProjectionWriter(projections)
+        self._open_session()
+        self._batching = True
+        try:
+            try:
+                yield self
+            finally:
+                self._batching = False
+                # savepoint commits do not count, only the batch's own commit
+                self._committed = False
+                self.projections = projections
+            self._commit_transaction(self.session)
+            held.release()
+        finally:
+            held.discard()
+            self.__exit__()
+        # the batch's events have all been collected by now
+        if self._cacheable:
+            self._cacheable = False
+            self.products.release()
+
+    def _commit_transaction(self, transaction: Union[Session, SessionTransaction]):
+        try:
+            transaction.commit()
+        except StaleDataError as e:
+            transaction.rollback()
+            raise errors.ConcurrencyConflict(str(e)) from e
+        except OperationalError as e:
+            transaction.rollback()
+            if getattr(e.orig, "pgcode", None) in CONFLICT_PGCODES:
+                raise errors.ConcurrencyConflict(str(e)) from e
+            raise
+        self._committed = True
+
+    def _commit(self):
+        if self._batching:
+            self._commit_transaction(self._savepoint)
+            return
+        self._commit_transaction(self.session)
+
+    def _add_to_outbox(self, messages: List[outbox.OutboxMessage]):
+        if not messages:
+            return
+        now = datetime.utcnow()
+        # aggregates are flushed by the commit, where version conflicts are
+        # turned into ConcurrencyConflict
+        with self.session.no_autoflush:
+            self.session.execute(
+                insert(orm.outbox),
+                [
+                    {"channel": m.channel, "payload": m.payload, "created_at": now}
+                    for m in messages
+                ],
+            )
 
     def rollback(self):
+        if self._batching:
+            if self._savepoint is not None and self._savepoint.is_active:
+                self._savepoint.rollback()
+            return
         self.session.rollback()
 
     def execute(self, query: str, payload: Payload = None):
         return self.session.execute(query, payload)
+
+    def register_batchref(self, batchref: str, sku: str):
+        if self.batchrefs is not None:
+            self.batchrefs.add(batchref, sku)
+
+    def collect_new_events(self):
+        yield from super().collect_new_events()
+        # products go back to the cache once their events have been handed out
+        if self._cacheable:
+            self._cacheable = False
+            self.products.release()
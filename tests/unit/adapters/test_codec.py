@@ -0,0 +1,92 @@
+from datetime import date
+
+import pytest
+
+from ddd_python.adapters import codec
+from ddd_python.domain import commands, events
+
+MESSAGES = [
+    events.Allocated("order1", "LAMP", 10, "batch1"),
+    events.BatchCreated("LAMP", "batch1", date(2021, 10, 7), 10),
+    events.BatchCreated("LAMP", "batch2", None, 10),
+    commands.CreateBatch("batch1", "LAMP", 10, date(2021, 10, 7)),
+    commands.Deallocate("batch1", "order1", "LAMP", 10),
+]
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_json_round_trips_into_the_dataclasses(message):
+    json_codec = codec.JsonCodec()
+
+    assert json_codec.decode(json_codec.encode(message), type(message)) == message
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_msgpack_round_trips_into_the_dataclasses(message):
+    pytest.importorskip("msgpack")
+    msgpack_codec = codec.MsgpackCodec()
+
+    assert msgpack_codec.decode(msgpack_codec.encode(message), type(message)) == message
+
+
+def test_json_keeps_the_existing_wire_format():
+    payload = codec.JsonCodec().encode(
+        events.BatchCreated("LAMP", "batch1", date(2021, 10, 7), 10)
+    )
+
+    assert payload == (
+        b'{"v":1,"sku":"LAMP","reference":"batch1","eta":"10/07/2021","qty":10}'
+    )
+
+
+def test_unversioned_payloads_from_other_services_are_decoded():
+    command = codec.JsonCodec().decode(
+        '{"ref": "batch1", "sku": "LAMP", "qty": "10", "eta": "10/07/2021"}',
+        commands.CreateBatch,
+    )
+
+    assert command == commands.CreateBatch("batch1", "LAMP", 10, date(2021, 10, 7))
+
+
+def test_newer_schema_versions_are_refused():
+    with pytest.raises(codec.CodecError, match="v2 is newer than v1"):
+        codec.JsonCodec().decode('{"v": 2, "sku": "LAMP"}', commands.CreateProduct)
+
+
+def test_older_schema_versions_are_upgraded(monkeypatch):
+    schema = codec.Schema(
+        commands.CreateProduct, version=2, upgrades={1: lambda data: {"sku": "LAMP"}}
+    )
+    monkeypatch.setitem(codec.SCHEMAS, commands.CreateProduct, schema)
+
+    command = codec.JsonCodec().decode(
+        '{"v": 1, "name": "lamp"}', commands.CreateProduct
+    )
+
+    assert command == commands.CreateProduct("LAMP")
+
+
+@pytest.mark.parametrize(
+    "payload, message_type",
+    [
+        ('{"sku": "LAMP"}', commands.Allocate),
+        ("not json", commands.Allocate),
+        ('{"orderid": "o", "sku": "L", "qty": "x"}', commands.Allocate),
+        ('"x"', commands.CreateBatch),
+        ("[1]", commands.CreateBatch),
+        ("null", commands.CreateBatch),
+        ('{"ref": "b", "sku": "L", "qty": 1, "eta": 738000}', commands.CreateBatch),
+        ('{"v": "1", "sku": "LAMP"}', commands.CreateProduct),
+    ],
+)
+def test_bad_payloads_raise_codec_errors(payload, message_type):
+    with pytest.raises(codec.CodecError):
+        codec.JsonCodec().decode(payload, message_type)
+
+
+def test_msgpack_rejects_dates_that_are_not_ordinals():
+    msgpack = pytest.importorskip("msgpack")
+    payload = msgpack.packb({"ref": "b", "sku": "L", "qty": 1, "eta": "10/07/2021"})
+
+    with pytest.raises(codec.CodecError):
+        codec.MsgpackCodec().decode(payload, commands.CreateBatch)
@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy import exc
+
+from ddd_python.adapters import database
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    engine = database.build_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        isolation_level="SERIALIZABLE",
+        pool_size=1,
+        max_overflow=1,
+        pool_timeout=0.01,
+    )
+    yield engine
+    engine.dispose()
+
+
+def test_pool_metrics_report_checked_out_connections(engine):
+    with engine.connect(), engine.connect():
+        metrics = database.pool_metrics(engine)
+
+    assert metrics["checked_out"] == 2
+    assert metrics["overflow"] == 1
+    assert metrics["checkouts"] == 2
+
+
+def test_pool_metrics_count_checkout_timeouts(engine):
+    with engine.connect(), engine.connect():
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+        metrics = database.pool_metrics(engine)
+
+    assert metrics["timeouts"] == 1
+    assert metrics["max_wait_seconds"] >= 0.01
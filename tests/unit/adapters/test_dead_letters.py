@@ -0,0 +1,19 @@
+from datetime import date
+
+from ddd_python.adapters import dead_letters
+from ddd_python.domain import events
+
+
+def test_dead_letters_are_persisted_and_removed(session_factory):
+    store = dead_letters.SqlAlchemyDeadLetterStore(session_factory)
+    event = events.BatchCreated("SMALL-FORK", "batch1", date(2021, 10, 7), 10)
+    store.add(dead_letters.DeadLetter("add_batch_to_read_model", event, "boom", 5))
+
+    [letter] = store.list()
+    assert letter.handler == "add_batch_to_read_model"
+    assert letter.event == event
+    assert letter.error == "boom"
+    assert letter.attempts == 5
+
+    store.remove(letter.id)
+    assert store.list() == []
@@ -0,0 +1,105 @@
+import pytest
+
+from ddd_python.adapters import circuit_breaker, event_publisher
+from ddd_python.domain import events
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    def __init__(self):
+        self.executed = []
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.messages = []
+
+    def publish(self, channel, payload):
+        self.messages.append((channel, payload))
+
+    def execute(self):
+        if self.redis.down:
+            raise ConnectionError("redis is down")
+        self.redis.executed.append(self.messages)
+
+
+def make_publisher(failure_threshold=2):
+    clock = Clock()
+    breaker = circuit_breaker.CircuitBreaker(
+        failure_threshold, reset_timeout=5, clock=clock
+    )
+    publisher = event_publisher.RedisPublisherAdapter(
+        "localhost", 6380, breaker=breaker
+    )
+    publisher.r = FakeRedis()
+    return publisher, clock
+
+
+def test_a_batch_of_messages_is_sent_in_one_pipeline():
+    publisher, _ = make_publisher()
+
+    publisher.publish_encoded(
+        [("product_created", b"LAMP"), ("product_created", b"SOFA")]
+    )
+
+    assert publisher.r.executed == [
+        [("product_created", b"LAMP"), ("product_created", b"SOFA")]
+    ]
+
+
+def test_publish_sends_the_event_at_once():
+    publisher, _ = make_publisher()
+
+    publisher.publish("product_created", events.ProductCreated("LAMP"))
+
+    assert publisher.r.executed == [[("product_created", b'{"v":1,"sku":"LAMP"}')]]
+
+
+def test_an_open_circuit_fails_fast_without_calling_redis():
+    publisher, clock = make_publisher(failure_threshold=2)
+    publisher.r.down = True
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            publisher.publish_encoded([("product_created", b"LAMP")])
+    assert publisher.breaker.is_open
+
+    publisher.r.down = False
+    with pytest.raises(circuit_breaker.CircuitOpen):
+        publisher.publish_encoded([("product_created", b"LAMP")])
+    assert publisher.r.executed == []
+
+    clock.now = 5
+    publisher.publish_encoded([("product_created", b"LAMP")])
+    assert publisher.r.executed == [[("product_created", b"LAMP")]]
+    assert not publisher.breaker.is_open
+
+
+def test_a_failed_probe_reopens_the_circuit():
+    clock = Clock()
+    breaker = circuit_breaker.CircuitBreaker(1, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+    with pytest.raises(circuit_breaker.CircuitOpen):
+        breaker.before_call()
+
+    clock.now = 5
+    breaker.before_call()
+    # other calls fail fast while the probe is out
+    with pytest.raises(circuit_breaker.CircuitOpen):
+        breaker.before_call()
+    breaker.record_failure()
+
+    clock.now = 9
+    with pytest.raises(circuit_breaker.CircuitOpen):
+        breaker.before_call()
@@ -0,0 +1,74 @@
+from datetime import date, datetime
+
+from sqlalchemy import insert, select
+
+from ddd_python.adapters import event_publisher, orm, outbox
+from ddd_python.domain import events
+
+
+def add_messages(session_factory, count):
+    with session_factory() as session:
+        session.execute(
+            insert(orm.outbox),
+            [
+                {
+                    "channel": "product_created",
+                    "payload": f'{{"sku": "SKU-{i}"}}'.encode(),
+                    "created_at": datetime.utcnow(),
+                }
+                for i in range(count)
+            ],
+        )
+        session.commit()
+
+
+def test_only_published_events_become_outbox_messages():
+    messages = outbox.to_messages(
+        [
+            events.BatchCreated("LAMP", "batch1", date(2021, 10, 7), 10),
+            events.OutOfStock("LAMP"),
+        ]
+    )
+
+    assert messages == [
+        outbox.OutboxMessage(
+            "batch_created",
+            b'{"v":1,"sku":"LAMP","reference":"batch1","eta":"10/07/2021","qty":10}',
+        )
+    ]
+
+
+def test_the_relay_publishes_batches_in_order_and_marks_them_sent(session_factory):
+    add_messages(session_factory, 5)
+    publisher = event_publisher.FakePublisherAdapter()
+    relay = outbox.OutboxRelay(session_factory, publisher, batch_size=3)
+
+    assert relay.relay_once() == 3
+    assert relay.relay_once() == 2
+    assert relay.relay_once() == 0
+
+    assert publisher.published_messages == {
+        "product_created": [f'{{"sku": "SKU-{i}"}}'.encode() for i in range(5)]
+    }
+    with session_factory() as session:
+        sent = session.execute(select(orm.outbox.c.sent_at)).scalars().all()
+    assert len(sent) == 5 and all(sent)
+
+
+def test_rows_stay_unsent_when_publishing_fails(session_factory):
+    class BrokenPublisher(event_publisher.FakePublisherAdapter):
+        def publish_encoded(self, messages):
+            raise ConnectionError("redis is down")
+
+    add_messages(session_factory, 2)
+    relay = outbox.OutboxRelay(session_factory, BrokenPublisher())
+
+    try:
+        relay.relay_once()
+    except ConnectionError:
+        pass
+    publisher = event_publisher.FakePublisherAdapter()
+    relay.publisher = publisher
+
+    assert relay.relay_once() == 2
+    assert len(publisher.published_messages["product_created"]) == 2
@@ -0,0 +1,148 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import event, select
+
+from ddd_python.adapters import orm, projections
+
+
+def rows(session_factory, table):
+    with session_factory() as session:
+        return [tuple(row) for row in session.execute(select(table))]
+
+
+def count_statements(session_factory, fn):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement != "BEGIN":
+            statements.append(executemany)
+
+    engine = session_factory.kw["bind"]
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return statements
+
+
+def test_an_insert_then_a_delete_of_the_same_line_writes_nothing():
+    changes = projections.Changes()
+    changes.insert_allocation("order1", "LAMP", "batch1")
+    changes.remove_allocation("order1", "LAMP")
+
+    assert changes.allocations == {}
+
+
+def test_a_delete_then_an_insert_replaces_the_row():
+    changes = projections.Changes()
+    changes.remove_allocation("order1", "LAMP")
+    changes.insert_allocation("order1", "LAMP", "batch2")
+    changes.update_allocation("order1", "LAMP", "batch3")
+
+    assert changes.allocations == {
+        ("order1", "LAMP"): projections.AllocationChange(True, "insert", "batch3")
+    }
+
+
+def test_allocations_are_flushed_with_one_statement_per_kind(session_factory):
+    writer = projections.SqlAlchemyProjectionWriter(session_factory)
+    writer.insert_allocation("old", "LAMP", "batch1")
+    writer.flush()
+
+    for i in range(5):
+        writer.insert_allocation(f"order{i}", "LAMP", "batch1")
+    writer.remove_allocation("order0", "LAMP")
+    writer.update_allocation("order1", "LAMP", "batch2")
+    writer.update_allocation("old", "LAMP", "batch2")
+    writer.remove_allocation("old", "LAMP")
+    statements = count_statements(session_factory, writer.flush)
+
+    # order0 was never written and the updates were folded, what is left is
+    # one delete and a single executemany insert
+    assert statements == [False, True]
+    assert sorted(rows(session_factory, orm.allocations_view)) == [
+        ("order1", "LAMP", "batch2"),
+        ("order2", "LAMP", "batch1"),
+        ("order3", "LAMP", "batch1"),
+        ("order4", "LAMP", "batch1"),
+    ]
+    assert writer.pending() == 0
+
+
+def test_batch_quantity_changes_are_folded_into_their_insert(session_factory):
+    writer = projections.SqlAlchemyProjectionWriter(session_factory)
+    writer.insert_product("LAMP")
+    writer.insert_batch("LAMP", "batch1", date(2021, 10, 7), 10)
+    writer.update_batch_qty("batch1", 5)
+    writer.flush()
+    writer.update_batch_qty("batch1", 3)
+    writer.flush()
+
+    assert rows(session_factory, orm.products_view) == [("LAMP",)]
+    assert rows(session_factory, orm.batches_view) == [
+        ("LAMP", "batch1", date(2021, 10, 7), 3)
+    ]
+
+
+def test_failed_flushes_are_written_before_newer_changes(session_factory):
+    def broken():
+        raise ConnectionError("postgres is down")
+
+    writer = projections.SqlAlchemyProjectionWriter(broken)
+    writer.insert_allocation("order1", "LAMP", "batch1")
+    writer.flush()
+    writer.session_factory = session_factory
+    writer.update_allocation("order1", "LAMP", "batch2")
+    writer.flush()
+
+    assert rows(session_factory, orm.allocations_view) == [("order1", "LAMP", "batch2")]
+
+
+def test_changes_wait_for_the_flush_interval():
+    writer = projections.FakeProjectionWriter(flush_interval=60)
+    writer.insert_product("LAMP")
+    writer.flush_if_due()
+    assert writer.flushed == []
+
+    writer.max_pending = 1
+    writer.flush_if_due()
+    assert list(writer.flushed[0].products) == ["LAMP"]
+
+
+def test_a_full_backlog_of_failed_flushes_refuses_new_changes(session_factory):
+    def broken():
+        raise ConnectionError("postgres is down")
+
+    writer = projections.SqlAlchemyProjectionWriter(broken, max_failed=1)
+    writer.insert_allocation("order1", "LAMP", "batch1")
+    writer.flush()
+
+    with pytest.raises(projections.ProjectionBacklogFull):
+        writer.insert_allocation("order2", "LAMP", "batch1")
+
+    writer.session_factory = session_factory
+    writer.flush_if_due()
+    writer.insert_allocation("order2", "LAMP", "batch1")
+    writer.flush()
+    assert rows(session_factory, orm.allocations_view) == [
+        ("order1", "LAMP", "batch1"),
+        ("order2", "LAMP", "batch1"),
+    ]
+
+
+def test_held_changes_reach_the_writer_only_when_released():
+    writer = projections.FakeProjectionWriter()
+    released = projections.HeldProjectionWriter(writer)
+    released.insert_product("LAMP")
+    released.flush_if_due()
+    assert writer.pending() == 0
+
+    released.release()
+    discarded = projections.HeldProjectionWriter(writer)
+    discarded.insert_product("CHAIR")
+    discarded.discard()
+    writer.flush()
+
+    assert [list(changes.products) for changes in writer.flushed] == [["LAMP"]]
@@ -0,0 +1,208 @@
+import pytest
+from redis.exceptions import ResponseError
+
+from ddd_python.adapters import event_publisher, redis_streams
+from ddd_python.domain import events
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStreams:
+    """Just enough of redis' stream commands for one consumer group."""
+
+    def __init__(self):
+        self.entries = {}
+        self.pending = {}
+        self.delivered = set()
+        self.times_delivered = {}
+        self.groups = set()
+        self.acked = []
+        # replies of the commands sent since the last execute
+        self.results = []
+
+    def add(self, stream, payload):
+        return self.xadd(stream, {b"data": payload})
+
+    def deliver(self, stream, entry_id, consumer):
+        self.pending.setdefault(stream, {})[entry_id] = consumer
+        key = (stream, entry_id)
+        self.times_delivered[key] = self.times_delivered.get(key, 0) + 1
+
+    def xgroup_create(self, stream, group, id, mkstream):
+        if (stream, group) in self.groups:
+            raise ResponseError("BUSYGROUP Consumer Group name already exists")
+        self.groups.add((stream, group))
+        self.entries.setdefault(stream, [])
+
+    def xreadgroup(self, group, consumer, streams, count, block):
+        response = []
+        for stream in streams:
+            fresh = [
+                e for e in self.entries[stream] if (stream, e[0]) not in self.delivered
+            ]
+            fresh = fresh[: count - sum(len(entries) for _, entries in response)]
+            for entry_id, _ in fresh:
+                self.delivered.add((stream, entry_id))
+                self.deliver(stream, entry_id, consumer)
+            if fresh:
+                response.append([stream.encode(), fresh])
+        return response
+
+    def xautoclaim(self, stream, group, consumer, min_idle_time, start_id, count):
+        pending = self.pending.get(stream, {})
+        start = int(start_id.split(b"-")[0])
+        scanned = [
+            e
+            for e in self.entries[stream]
+            if e[0] in pending and int(e[0].split(b"-")[0]) >= start
+        ]
+        claimed, rest = scanned[:count], scanned[count:]
+        for entry_id, _ in claimed:
+            self.deliver(stream, entry_id, consumer)
+        return [rest[0][0] if rest else b"0-0", claimed, []]
+
+    def xpending_range(self, stream, group, min, max, count):
+        if min not in self.pending.get(stream, {}):
+            self.results.append([])
+            return
+        delivered = self.times_delivered[(stream, min)]
+        self.results.append([{"message_id": min, "times_delivered": delivered}])
+
+    def pipeline(self, transaction=True):
+        self.results = []
+        return self
+
+    def xack(self, stream, group, *ids):
+        self.acked.append((stream, ids))
+        for entry_id in ids:
+            self.pending[stream].pop(entry_id)
+        self.results.append(len(ids))
+
+    def xadd(self, stream, fields, maxlen=None, approximate=True):
+        entries = self.entries.setdefault(stream, [])
+        entry_id = f"{len(entries) + 1}-0".encode()
+        entries.append((entry_id, fields))
+        self.results.append(entry_id)
+        return entry_id
+
+    def execute(self):
+        results, self.results = self.results, []
+        return results
+
+
+def make_consumer(redis, batch_size=10, clock=None, max_deliveries=5):
+    consumer = redis_streams.StreamConsumer(
+        redis,
+        "allocation",
+        "worker-1",
+        ["allocate", "add_batch"],
+        batch_size=batch_size,
+        claim_idle_ms=1000,
+        max_deliveries=max_deliveries,
+        clock=clock or Clock(),
+    )
+    consumer.ensure_groups()
+    return consumer
+
+
+def test_groups_are_created_once():
+    redis = FakeStreams()
+    make_consumer(redis)
+    make_consumer(redis)
+
+    assert redis.groups == {("allocate", "allocation"), ("add_batch", "allocation")}
+
+
+def test_entries_are_read_in_batches_across_streams():
+    redis = FakeStreams()
+    consumer = make_consumer(redis, batch_size=2)
+    for payload in [b"a1", b"a2", b"a3"]:
+        redis.add("allocate", payload)
+    redis.add("add_batch", b"b1")
+
+    first = consumer.read()
+    consumer.ack(first)
+    second = consumer.read()
+
+    assert [m.data for m in first] == [b"a1", b"a2"]
+    assert [(m.stream, m.data) for m in second] == [
+        ("allocate", b"a3"),
+        ("add_batch", b"b1"),
+    ]
+    assert redis.acked == [("allocate", (b"1-0", b"2-0"))]
+
+
+def test_entries_left_pending_are_claimed_after_the_idle_time():
+    redis = FakeStreams()
+    clock = Clock()
+    crashed = make_consumer(redis, clock=clock)
+    redis.add("allocate", b"a1")
+    crashed.read()  # never acked
+
+    survivor = make_consumer(redis, clock=clock)
+    survivor._claimed_at = clock.now
+    assert survivor.read() == []
+
+    clock.now = 1
+    [claimed] = survivor.read()
+    assert claimed.data == b"a1"
+    assert redis.pending["allocate"] == {b"1-0": "worker-1"}
+
+
+def test_a_claim_scan_drains_the_pending_lists_one_batch_per_read():
+    redis = FakeStreams()
+    clock = Clock()
+    crashed = make_consumer(redis, batch_size=100, clock=clock)
+    for i in range(5):
+        redis.add("allocate", f"a{i}".encode())
+    crashed.read()  # never acked
+
+    survivor = make_consumer(redis, batch_size=2, clock=clock)
+    reads = [[m.data for m in survivor.read()] for _ in range(3)]
+
+    assert reads == [[b"a0", b"a1"], [b"a2", b"a3"], [b"a4"]]
+    assert survivor._claim_cursors == {}
+
+
+def test_failed_entries_stay_pending_until_they_run_out_of_deliveries():
+    redis = FakeStreams()
+    clock = Clock()
+    consumer = make_consumer(redis, clock=clock, max_deliveries=2)
+    consumer._claimed_at = clock.now
+    redis.add("allocate", b"a1")
+
+    [message] = consumer.read()
+    assert consumer.fail([message]) == []
+    assert b"1-0" in redis.pending["allocate"]
+
+    clock.now = 1
+    [claimed] = consumer.read()
+    assert consumer.fail([claimed]) == [claimed]
+
+    assert redis.pending["allocate"] == {}
+    assert redis.entries["allocate:dead"] == [(b"1-0", {b"data": b"a1", b"id": b"1-0"})]
+
+
+def test_other_group_errors_are_raised():
+    class Broken(FakeStreams):
+        def xgroup_create(self, *args, **kwargs):
+            raise ResponseError("WRONGTYPE")
+
+    with pytest.raises(ResponseError):
+        make_consumer(Broken())
+
+
+def test_the_stream_publisher_appends_to_the_channel_stream():
+    publisher = event_publisher.RedisStreamPublisherAdapter("localhost", 6380)
+    publisher.r = FakeStreams()
+    publisher.publish("product_created", events.ProductCreated("LAMP"))
+
+    assert publisher.r.entries == {
+        "product_created": [(b"1-0", {b"data": b'{"v":1,"sku":"LAMP"}'})]
+    }
@@ -1,4 +1,7 @@
-from datetime import date
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event
 
 from ddd_python.adapters import repository
 from ddd_python.domain import model
@@ -95,3 +98,179 @@ def test_repository_can_retrieve_a_batch_with_allocations(session):
     assert len(retrieved_product.batches) == 1
     assert len(retrieved_product.batches[0].allocations) == 1
     assert retrieved_product.batches[0].allocations[0] == orderline
+
+
+def test_repository_loads_allocations_into_an_allocation_store(session):
+    batch = model.Batch("batch1", "GENERIC-SOFA", 20, eta=date.today())
+    batch.allocate(model.OrderLine("order1", "GENERIC-SOFA", 2))
+    batch.allocate(model.OrderLine("order2", "GENERIC-SOFA", 3))
+    repository.SqlAlchemyProductRepository(session).add(
+        model.Product("GENERIC-SOFA", [batch])
+    )
+    session.commit()
+    session.expunge_all()
+
+    repo = repository.SqlAlchemyProductRepository(session)
+    retrieved_batch = repo.get("GENERIC-SOFA").batches[0]
+
+    assert isinstance(retrieved_batch.allocations, model.Allocations)
+    assert retrieved_batch.available_quantity == 15
+    assert retrieved_batch.deallocate_one().orderid == "order2"
+
+
+def test_repository_persists_deallocations(session):
+    batch = model.Batch("batch1", "GENERIC-SOFA", 20, eta=date.today())
+    batch.allocate(model.OrderLine("order1", "GENERIC-SOFA", 2))
+    repository.SqlAlchemyProductRepository(session).add(
+        model.Product("GENERIC-SOFA", [batch])
+    )
+    session.commit()
+    session.expunge_all()
+
+    product = repository.SqlAlchemyProductRepository(session).get("GENERIC-SOFA")
+    product.deallocate("batch1", model.OrderLine("order1", "GENERIC-SOFA", 2))
+    session.commit()
+
+    rows = session.execute("SELECT batch_id FROM order_lines WHERE orderid='order1'")
+    assert list(rows) == [(None,)]
+
+
+def add_product_with_batches(session, sku, batch_count):
+    # all but the last batch are full, so allocate has to look at every batch
+    today = date.today()
+    batches = [
+        model.Batch(f"{sku}-batch{i}", sku, 10, eta=today + timedelta(days=i))
+        for i in range(batch_count)
+    ]
+    for i, batch in enumerate(batches[:-1]):
+        batch.allocate(model.OrderLine(f"order{i}", sku, 10))
+    session.add(model.Product(sku, batches))
+    session.commit()
+    session.expunge_all()
+
+
+def count_allocate_statements(session, sku, load_strategy):
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        repo = repository.SqlAlchemyProductRepository(session, load_strategy)
+        product = repo.get(sku)
+        assert product.allocate(model.OrderLine("new-order", sku, 1))
+        session.commit()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return len(statements)
+
+
+@pytest.mark.parametrize("load_strategy", ["selectin", "joined"])
+def test_eager_loaded_allocate_costs_constant_statements(session, load_strategy):
+    add_product_with_batches(session, "SMALL-SOFA", 1)
+    add_product_with_batches(session, "LARGE-SOFA", 50)
+
+    small = count_allocate_statements(session, "SMALL-SOFA", load_strategy)
+    large = count_allocate_statements(session, "LARGE-SOFA", load_strategy)
+
+    assert small == large
+
+
+def test_lazy_loaded_allocate_costs_a_statement_per_batch(session):
+    add_product_with_batches(session, "SMALL-SOFA", 1)
+    add_product_with_batches(session, "LARGE-SOFA", 50)
+
+    small = count_allocate_statements(session, "SMALL-SOFA", "lazy")
+    large = count_allocate_statements(session, "LARGE-SOFA", "lazy")
+
+    assert large - small == 49
+
+
+def count_statements(session, fn):
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        result = fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return result, len(statements)
+
+
+def test_get_many_loads_products_in_constant_statements(session):
+    skus = [f"SOFA-{i}" for i in range(10)]
+    for sku in skus:
+        add_product_with_batches(session, sku, 3)
+    repo = repository.SqlAlchemyProductRepository(session)
+
+    few, few_statements = count_statements(session, lambda: repo.get_many(skus[:2]))
+    many, many_statements = count_statements(session, lambda: repo.get_many(skus[2:]))
+
+    assert {product.sku for product in few + many} == set(skus)
+    assert repo.seen == set(few + many)
+    assert few_statements == many_statements
+
+
+def test_stream_yields_every_product_without_tracking_them(session):
+    skus = [f"SOFA-{i}" for i in range(10)]
+    for sku in skus:
+        add_product_with_batches(session, sku, 2)
+    repo = repository.SqlAlchemyProductRepository(session)
+
+    streamed = [
+        (product.sku, len(product.batches)) for product in repo.stream(chunk_size=3)
+    ]
+
+    assert streamed == [(sku, 2) for sku in skus]
+    assert repo.seen == set()
+
+
+def test_get_by_batchref_remembers_the_sku_of_a_batch(session):
+    add_product_with_batches(session, "GENERIC-SOFA", 2)
+    batchrefs = repository.BatchrefIndex()
+    repo = repository.SqlAlchemyProductRepository(session, batchrefs=batchrefs)
+
+    first, first_statements = count_statements(
+        session, lambda: repo.get_by_batchref("GENERIC-SOFA-batch1")
+    )
+    session.expunge_all()
+    second, second_statements = count_statements(
+        session, lambda: repo.get_by_batchref("GENERIC-SOFA-batch1")
+    )
+
+    assert first.sku == second.sku == "GENERIC-SOFA"
+    assert batchrefs.get("GENERIC-SOFA-batch1") == "GENERIC-SOFA"
+    assert second_statements == first_statements - 1
+
+
+def test_get_by_batchref_returns_none_for_unknown_batches(session):
+    repo = repository.SqlAlchemyProductRepository(
+        session, batchrefs=repository.BatchrefIndex()
+    )
+
+    assert repo.get_by_batchref("missing-batch") is None
+
+
+def test_fake_repository_finds_batches_added_after_the_product():
+    product = model.Product("GENERIC-SOFA", [])
+    repo = repository.FakeProductRepository([product])
+    product.add_batches([model.Batch("batch1", "GENERIC-SOFA", 10, date.today())])
+
+    assert repo.get_by_batchref("batch1") is product
+    assert repo.get_by_batchref("missing-batch") is None
+
+
+def test_fake_repository_finds_batches_added_after_a_miss():
+    product = model.Product("GENERIC-SOFA", [])
+    repo = repository.FakeProductRepository([product])
+    assert repo.get_by_batchref("missing-batch") is None
+
+    product.add_batches([model.Batch("batch1", "GENERIC-SOFA", 10, date.today())])
+
+    assert repo.get_by_batchref("batch1") is product
@@ -1,6 +1,6 @@
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
 
 from ddd_python.adapters import orm
 
@@ -14,3 +14,28 @@ def session():
         yield session
     orm.clear_mappers()
     orm.metadata.drop_all(engine)
+
+
+def use_sqlite_savepoints(engine):
+    # pysqlite only begins a transaction before the first INSERT/UPDATE/DELETE,
+    # so a SAVEPOINT emitted before that opens the transaction itself and its
+    # RELEASE commits it. As in the SQLAlchemy docs' workaround, BEGIN is
+    # emitted as soon as SQLAlchemy begins. pysqlite's own handling stays on:
+    # sessions of one thread share the in memory database's connection, and
+    # it keeps the statements of a session that joined a transaction another
+    # one has since committed transactional
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        if not conn.connection.dbapi_connection.in_transaction:
+            conn.exec_driver_sql("BEGIN")
+
+
+@pytest.fixture()
+def session_factory():
+    engine = create_engine("sqlite://")
+    use_sqlite_savepoints(engine)
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    yield sessionmaker(bind=engine, expire_on_commit=False)
+    orm.clear_mappers()
+    orm.metadata.drop_all(engine)
@@ -1,5 +1,7 @@
 from datetime import date
 
+import pytest
+
 from ddd_python.domain import model
 
 
@@ -46,8 +48,52 @@ def test_can_only_deallocate_allocated_lines():
     assert batch.available_quantity == 20
 
 
+def test_removing_an_unallocated_line_raises():
+    batch, unallocated_line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    with pytest.raises(ValueError):
+        batch.remove_allocation(unallocated_line)
+
+
 def test_allocation_is_idempotent():
     batch, line = make_batch_and_line("ANGULAR-DESK", 20, 2)
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocating_restores_the_available_quantity():
+    batch, line = make_batch_and_line("ANGULAR-DESK", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+
+def test_deallocate_one_returns_the_most_recent_allocation():
+    batch, line = make_batch_and_line("ANGULAR-DESK", 20, 2)
+    latest = model.OrderLine("order-456", "ANGULAR-DESK", 5)
+    batch.allocate(line)
+    batch.allocate(latest)
+
+    assert batch.deallocate_one() == latest
+    assert batch.allocated_quantity == 2
+
+
+def test_allocations_are_keyed_by_orderid_and_sku():
+    batch, line = make_batch_and_line("ANGULAR-DESK", 20, 2)
+    batch.allocate(line)
+
+    batch.deallocate(model.OrderLine(line.orderid, line.sku, 1))
+
+    assert len(batch.allocations) == 0
+    assert batch.available_quantity == 20
+
+
+def test_allocations_keep_a_running_quantity():
+    lines = [model.OrderLine(f"order-{i}", "ANGULAR-DESK", i) for i in range(5)]
+    allocations = model.Allocations(lines)
+    allocations.append(lines[0])
+    allocations.remove(lines[4])
+
+    assert allocations.quantity == 6
+    assert list(allocations) == lines[:4]
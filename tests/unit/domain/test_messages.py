@@ -0,0 +1,25 @@
+from dataclasses import asdict, fields
+
+import pytest
+
+from ddd_python.domain import commands, events
+
+MESSAGE_TYPES = [*events.Event.__subclasses__(), *commands.Command.__subclasses__()]
+
+
+@pytest.mark.parametrize("message_type", MESSAGE_TYPES)
+def test_messages_are_slotted(message_type):
+    message = message_type(*(None for _ in fields(message_type)))
+
+    assert not hasattr(message, "__dict__")
+
+
+def test_slotted_events_can_be_converted_to_dicts():
+    event = events.Allocated("order1", "SMALL-FORK", 10, "batch1")
+
+    assert asdict(event) == {
+        "orderid": "order1",
+        "sku": "SMALL-FORK",
+        "qty": 10,
+        "batchref": "batch1",
+    }
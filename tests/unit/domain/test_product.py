@@ -64,6 +64,109 @@ def test_raises_out_of_stock_exception_if_cannot_allocate():
     assert product.events == [events.OutOfStock("SMALL-FORK")]
 
 
+def test_batches_with_the_same_eta_are_allocated_in_reference_order():
+    today = date.today()
+    second = model.Batch("batch-b", "SMALL-FORK", 10, eta=today)
+    first = model.Batch("batch-a", "SMALL-FORK", 10, eta=today)
+    product = model.Product("SMALL-FORK", [second, first])
+
+    assert product.allocate(model.OrderLine("order1", "SMALL-FORK", 1)) == "batch-a"
+
+
+def test_full_batches_are_skipped_until_stock_is_freed():
+    earliest = model.Batch("speedy-batch", "SMALL-FORK", 10, eta=None)
+    latest = model.Batch(
+        "slow-batch", "SMALL-FORK", 10, eta=date.today() + timedelta(days=1)
+    )
+    product = model.Product("SMALL-FORK", [earliest, latest])
+    line = model.OrderLine("order1", "SMALL-FORK", 10)
+
+    assert product.allocate(line) == "speedy-batch"
+    assert product.allocate(model.OrderLine("order2", "SMALL-FORK", 1)) == "slow-batch"
+
+    product.deallocate("speedy-batch", line)
+
+    assert product.allocate(model.OrderLine("order3", "SMALL-FORK", 1)) == (
+        "speedy-batch"
+    )
+
+
+def test_batches_added_later_are_allocated_in_eta_order():
+    latest = model.Batch(
+        "slow-batch", "SMALL-FORK", 10, eta=date.today() + timedelta(days=2)
+    )
+    product = model.Product("SMALL-FORK", [latest])
+    product.allocate(model.OrderLine("order1", "SMALL-FORK", 1))
+
+    product.add_batches([model.Batch("speedy-batch", "SMALL-FORK", 10, date.today())])
+
+    assert product.allocate(model.OrderLine("order2", "SMALL-FORK", 1)) == (
+        "speedy-batch"
+    )
+
+
+def test_batch_with_increased_quantity_can_be_allocated_again():
+    batch = model.Batch("batch1", "SMALL-FORK", 10, eta=date.today())
+    product = model.Product("SMALL-FORK", [batch])
+    product.allocate(model.OrderLine("order1", "SMALL-FORK", 10))
+
+    product.change_batch_quantity("batch1", 20)
+
+    assert product.allocate(model.OrderLine("order2", "SMALL-FORK", 5)) == "batch1"
+
+
+def test_batches_loaded_after_indexing_can_be_found_by_reference():
+    product = model.Product("SMALL-FORK", [])
+    product.allocate(model.OrderLine("order1", "SMALL-FORK", 1))
+    line = model.OrderLine("order2", "SMALL-FORK", 1)
+    batch = model.Batch("batch1", "SMALL-FORK", 10, eta=date.today())
+    batch.allocate(line)
+
+    # mimics the ORM hydrating batches without going through add_batches
+    product.batches.append(batch)
+    product.deallocate("batch1", line)
+
+    assert batch.available_quantity == 10
+
+
+def test_allocate_many_matches_allocating_one_line_at_a_time():
+    def make_product():
+        return model.Product(
+            "SMALL-FORK",
+            [
+                model.Batch("batch1", "SMALL-FORK", 10, eta=None),
+                model.Batch("batch2", "SMALL-FORK", 5, eta=date.today()),
+                model.Batch(
+                    "batch3", "SMALL-FORK", 20, eta=date.today() + timedelta(days=1)
+                ),
+            ],
+        )
+
+    lines = [
+        model.OrderLine(f"order{i}", "SMALL-FORK", qty)
+        for i, qty in enumerate([4, 7, 5, 3, 12, 9, 1])
+    ]
+    one_at_a_time, many = make_product(), make_product()
+
+    refs = [one_at_a_time.allocate(line) for line in lines]
+
+    assert many.allocate_many(lines) == refs
+    assert many.events == one_at_a_time.events
+    assert many.version_number == one_at_a_time.version_number
+    assert many.allocate(model.OrderLine("order9", "SMALL-FORK", 1)) == (
+        one_at_a_time.allocate(model.OrderLine("order9", "SMALL-FORK", 1))
+    )
+
+
+def test_allocate_many_reports_out_of_stock_per_line():
+    product = model.Product("SMALL-FORK", [])
+
+    refs = product.allocate_many([model.OrderLine("order1", "SMALL-FORK", 1)])
+
+    assert refs == [None]
+    assert product.events[-1] == events.OutOfStock("SMALL-FORK")
+
+
 def test_version_number_incremented_when_allocated():
     batch = model.Batch("batch1", "SMALL-FORK", 10, eta=date.today())
     product = model.Product("SMALL-FORK", [batch])
@@ -123,3 +226,54 @@ def test_version_number_incremented_when_bathes_ordered():
     batch = model.Batch("batch1", "SMALL-FORK", 10, eta=date.today())
     product.add_batches([batch])
     assert product.version_number == 1
+
+
+# REALLOCATION
+
+
+def test_shrinking_a_batch_moves_lines_to_other_batches():
+    small = model.Batch("batch1", "SMALL-FORK", 10, eta=None)
+    large = model.Batch("batch2", "SMALL-FORK", 50, eta=date.today())
+    product = model.Product("SMALL-FORK", [small, large])
+    first = model.OrderLine("order1", "SMALL-FORK", 4)
+    second = model.OrderLine("order2", "SMALL-FORK", 5)
+    product.allocate(first)
+    product.allocate(second)
+
+    product.change_batch_quantity("batch1", 5)
+
+    assert small.available_quantity == 1
+    assert large.available_quantity == 45
+    assert product.events[-2:] == [
+        events.BatchQuantityChanged(ref="batch1", qty=5),
+        events.Reallocated("order2", "SMALL-FORK", 5, "batch2", "batch1"),
+    ]
+
+
+def test_lines_that_fit_back_into_the_shrunk_batch_are_not_moved():
+    batch = model.Batch("batch1", "SMALL-FORK", 10, eta=None)
+    product = model.Product("SMALL-FORK", [batch])
+    product.allocate(model.OrderLine("order1", "SMALL-FORK", 2))
+    product.allocate(model.OrderLine("order2", "SMALL-FORK", 6))
+    product.allocate(model.OrderLine("order3", "SMALL-FORK", 1))
+
+    product.change_batch_quantity("batch1", 4)
+
+    assert batch.allocated_quantity == 3
+    assert product.events[-3:] == [
+        events.BatchQuantityChanged(ref="batch1", qty=4),
+        events.Deallocated("order2", "SMALL-FORK"),
+        events.OutOfStock("SMALL-FORK"),
+    ]
+
+
+def test_shrinking_a_batch_increments_the_version_number_once():
+    batch = model.Batch("batch1", "SMALL-FORK", 10, eta=None)
+    product = model.Product("SMALL-FORK", [batch])
+    for i in range(5):
+        product.allocate(model.OrderLine(f"order{i}", "SMALL-FORK", 2))
+    version_number = product.version_number
+
+    product.change_batch_quantity("batch1", 0)
+
+    assert product.version_number == version_number + 1
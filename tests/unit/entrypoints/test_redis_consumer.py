@@ -0,0 +1,151 @@
+from datetime import date
+
+import pytest
+
+from ddd_python.adapters import codec
+from ddd_python.domain import commands
+from ddd_python.entrypoints import redis_consumer
+from ddd_python.service_layer import bootstrap
+
+
+def encode(command):
+    return redis_consumer.CODEC.encode(command)
+
+
+@pytest.mark.parametrize(
+    "channel, command",
+    [
+        ("add_products", commands.CreateProduct("SMALL-FORK")),
+        ("add_batch", commands.CreateBatch("batch1", "SMALL-FORK", 10, date.today())),
+        ("change_batch_quantity", commands.ChangeBatchQuantity("batch1", 5)),
+        ("allocate", commands.Allocate("order1", "SMALL-FORK", 2)),
+        ("deallocate", commands.Deallocate("batch1", "order1", "SMALL-FORK", 2)),
+    ],
+)
+def test_every_channel_decodes_to_its_command(channel, command):
+    assert redis_consumer.decode_command(channel, encode(command)) == command
+
+
+def test_unknown_channels_decode_to_nothing():
+    assert redis_consumer.decode_command("line_allocated", b"{}") is None
+
+
+def test_undecodable_payloads_raise_a_codec_error():
+    with pytest.raises(codec.CodecError):
+        redis_consumer.decode_command("allocate", b"not a payload")
+
+
+def test_messages_are_handled_on_one_bus_and_failures_are_skipped():
+    bus = bootstrap.bootstrap(testing=True)
+    batch = commands.CreateBatch("batch1", "SMALL-FORK", 10, date.today())
+    line = ("order1", "SMALL-FORK", 2)
+
+    failed = redis_consumer.handle_messages(
+        bus,
+        [
+            ("add_products", encode(commands.CreateProduct("SMALL-FORK"))),
+            ("add_batch", encode(batch)),
+            ("allocate", b"not a payload"),
+            ("add_batch", b"[1]"),
+            ("add_batch", b"null"),
+            ("deallocate", encode(commands.Deallocate("missing", *line))),
+            ("allocate", encode(commands.Allocate(*line))),
+        ],
+    )
+
+    assert failed == [2, 3, 4, 5]
+    product = bus.uow.products.get("SMALL-FORK")
+    assert product.batches[0].available_quantity == 8
+
+
+def test_every_line_of_a_failed_group_is_reported():
+    bus = bootstrap.bootstrap(testing=True)
+
+    failed = redis_consumer.handle_messages(
+        bus,
+        [
+            ("allocate", encode(commands.Allocate("order1", "MISSING", 1))),
+            ("add_products", encode(commands.CreateProduct("SMALL-FORK"))),
+            ("allocate", encode(commands.Allocate("order2", "MISSING", 1))),
+            ("allocate", encode(commands.Allocate("order3", "MISSING", 1))),
+        ],
+        group=True,
+    )
+
+    assert failed == [0, 2, 3]
+
+
+def test_allocates_are_grouped_by_sku_in_arrival_order():
+    batch = commands.CreateBatch("batch1", "SMALL-FORK", 10, date.today())
+    fork1 = commands.Allocate("order1", "SMALL-FORK", 1)
+    lamp = commands.Allocate("order2", "LAMP", 1)
+    fork2 = commands.Allocate("order3", "SMALL-FORK", 2)
+    fork3 = commands.Allocate("order4", "SMALL-FORK", 3)
+
+    grouped = redis_consumer.group_allocations([fork1, lamp, fork2, batch, fork3])
+
+    assert grouped == [
+        commands.AllocateMany("SMALL-FORK", [fork1, fork2]),
+        commands.AllocateMany("LAMP", [lamp]),
+        batch,
+        commands.AllocateMany("SMALL-FORK", [fork3]),
+    ]
+
+
+def test_grouped_allocates_commit_once_per_sku():
+    bus = bootstrap.bootstrap(testing=True)
+    for sku in ("SMALL-FORK", "LAMP"):
+        bus.handle(commands.CreateProduct(sku))
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 10, date.today()))
+    commits = []
+    bus.uow._commit = lambda: commits.append(len(commits))
+
+    redis_consumer.handle_messages(
+        bus,
+        [
+            ("allocate", encode(commands.Allocate("order1", "SMALL-FORK", 4))),
+            ("allocate", encode(commands.Allocate("order2", "LAMP", 1))),
+            ("allocate", encode(commands.Allocate("order3", "SMALL-FORK", 4))),
+            ("allocate", encode(commands.Allocate("order4", "SMALL-FORK", 4))),
+        ],
+        group=True,
+    )
+
+    assert len(commits) == 2
+    assert bus.uow.products.get("SMALL-FORK").batches[0].available_quantity == 2
+    assert bus.uow.products.get("LAMP").batches[0].available_quantity == 9
+    allocated = [m for m in bus.uow.outboxed if m.channel == "line_allocated"]
+    assert len(allocated) == 3
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.timeouts = []
+
+    def get_message(self, timeout):
+        self.timeouts.append(timeout)
+        if not self.messages:
+            return None
+        channel, data = self.messages.pop(0)
+        if channel is None:
+            return None
+        return {"channel": channel.encode(), "data": data}
+
+
+def test_read_pubsub_stops_at_max_messages():
+    pubsub = FakePubSub([(None, None), ("allocate", b"a1"), ("allocate", b"a2")])
+
+    assert redis_consumer.read_pubsub(pubsub, 1, max_wait=1) == [("allocate", b"a1")]
+    # it blocks until the first message, skipping subscribe confirmations
+    assert pubsub.timeouts == [None, None]
+
+
+def test_read_pubsub_stops_once_max_wait_is_over():
+    pubsub = FakePubSub([("allocate", b"a1"), ("add_batch", b"b1")])
+
+    messages = redis_consumer.read_pubsub(pubsub, 100, max_wait=0.01)
+
+    assert messages == [("allocate", b"a1"), ("add_batch", b"b1")]
+    assert pubsub.timeouts[0] is None
+    assert all(0 < timeout <= 0.01 for timeout in pubsub.timeouts[1:])
@@ -0,0 +1,134 @@
+
+import pytest
+
+from ddd_python.adapters import email, event_publisher
+from ddd_python.domain import commands, events, model
+from ddd_python.service_layer import errors, handlers, unit_of_work
+from ddd_python.service_layer.messagebus import MessageBus
+
+
+def make_bus(command_handlers, event_handlers=None):
+    class TestBus(MessageBus):
+        COMMAND_HANDLERS = command_handlers
+        EVENT_HANDLERS = event_handlers or {}
+        RETRY_BASE_DELAY = 0
+
+    uow = unit_of_work.FakeUnitOfWork(
+        email.FakeEmailAdapter(), event_publisher.FakePublisherAdapter()
+    )
+    uow.products.add(model.Product("SMALL-FORK", []))
+    list(uow.collect_new_events())
+    return TestBus(uow)
+
+
+def conflicting(times, result="done"):
+    calls = []
+
+    def handler(command, uow):
+        calls.append(command)
+        uow.products.get("SMALL-FORK").events.append(events.OutOfStock("SMALL-FORK"))
+        if len(calls) <= times:
+            raise errors.ConcurrencyConflict()
+        return result
+
+    return handler, calls
+
+
+def test_commands_are_retried_after_a_concurrency_conflict():
+    handler, calls = conflicting(times=2)
+    handled = []
+    bus = make_bus(
+        {commands.CreateProduct: handler},
+        {events.OutOfStock: [lambda event, uow, queue: handled.append(event)]},
+    )
+
+    assert bus.handle(commands.CreateProduct("SMALL-FORK")) == ["done"]
+    assert len(calls) == 3
+    # events of the attempts that were rolled back are not handled
+    assert handled == [events.OutOfStock("SMALL-FORK")]
+
+
+def test_conflicts_are_raised_once_attempts_run_out():
+    handler, calls = conflicting(times=MessageBus.COMMAND_ATTEMPTS)
+    bus = make_bus({commands.CreateProduct: handler})
+
+    with pytest.raises(errors.ConcurrencyConflict):
+        bus.handle(commands.CreateProduct("SMALL-FORK"))
+    assert len(calls) == MessageBus.COMMAND_ATTEMPTS
+
+
+def test_handle_batch_reports_each_message_on_its_own():
+    def handler(command, uow):
+        if command.sku == "BROKEN":
+            raise ValueError(command.sku)
+        return command.sku
+
+    bus = make_bus({commands.CreateProduct: handler})
+
+    handled = bus.handle_batch(
+        [commands.CreateProduct(sku) for sku in ["SMALL-FORK", "BROKEN", "LAMP"]]
+    )
+
+    assert [result.results for result in handled] == [["SMALL-FORK"], [], ["LAMP"]]
+    assert isinstance(handled[1].error, ValueError)
+
+
+def test_handle_many_keeps_going_after_a_failed_message():
+    def handler(command, uow):
+        product = uow.products.get("SMALL-FORK")
+        product.events.append(events.OutOfStock(command.sku))
+        if command.sku == "BROKEN":
+            raise ValueError(command.sku)
+        return command.sku
+
+    handled_events = []
+    bus = make_bus(
+        {commands.CreateProduct: handler},
+        {events.OutOfStock: [lambda event, uow, queue: handled_events.append(event)]},
+    )
+
+    handled = bus.handle_many(
+        [commands.CreateProduct(sku) for sku in ["SMALL-FORK", "BROKEN", "LAMP"]]
+    )
+
+    assert [result.results for result in handled] == [["SMALL-FORK"], [], ["LAMP"]]
+    assert isinstance(handled[1].error, ValueError)
+    assert handled_events == [
+        events.OutOfStock("SMALL-FORK"),
+        events.OutOfStock("LAMP"),
+    ]
+
+
+def test_follow_up_messages_are_handled_in_order():
+    handled = []
+
+    def fan_out(command, uow):
+        product = uow.products.get("SMALL-FORK")
+        product.events.extend(events.ProductCreated(str(i)) for i in range(3))
+
+    def record(event, uow, queue):
+        handled.append(event.sku)
+        if event.sku == "0":
+            uow.products.get("SMALL-FORK").events.append(events.ProductCreated("0a"))
+
+    bus = make_bus({commands.CreateProduct: fan_out}, {events.ProductCreated: [record]})
+
+    bus.handle(commands.CreateProduct("SMALL-FORK"))
+
+    assert handled == ["0", "1", "2", "0a"]
+
+
+def test_read_model_changes_are_flushed_once_per_cycle():
+    def fan_out(command, uow):
+        product = uow.products.get("SMALL-FORK")
+        product.events.extend(events.ProductCreated(sku) for sku in ["A", "B"])
+
+    bus = make_bus(
+        {commands.CreateProduct: fan_out},
+        {events.ProductCreated: [handlers.add_product_to_read_model]},
+    )
+
+    bus.handle(commands.CreateProduct("SMALL-FORK"))
+
+    [flushed] = bus.uow.projections.flushed
+    assert list(flushed.products) == ["A", "B"]
@@ -0,0 +1,160 @@
+from datetime import date
+
+from ddd_python.adapters import dead_letters
+from ddd_python.domain import events
+from ddd_python.service_layer import bootstrap, retries
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def flaky(times):
+    calls = []
+
+    def handler(event, uow, queue):
+        calls.append(event)
+        if len(calls) <= times:
+            raise ConnectionError("redis is down")
+
+    return handler, calls
+
+
+def make_bus(handler, max_attempts=3):
+    bus = bootstrap.bootstrap(testing=True)
+    bus.EVENT_HANDLERS = {events.OutOfStock: [handler]}
+    clock = Clock()
+    bus.retries = retries.RetryScheduler(
+        bus.retry_handler,
+        dead_letters.FakeDeadLetterStore(),
+        max_attempts=max_attempts,
+        base_delay=1,
+        clock=clock,
+    )
+    return bus, clock
+
+
+def test_failed_handlers_are_scheduled_instead_of_retried_inline():
+    handler, calls = flaky(times=1)
+    bus, clock = make_bus(handler)
+
+    bus.handle(events.OutOfStock("SMALL-FORK"))
+
+    assert len(calls) == 1
+    assert len(bus.retries) == 1
+    assert bus.retries.run_pending() == 0
+
+    clock.now = 1
+    assert bus.retries.run_pending() == 1
+    assert len(calls) == 2
+    assert len(bus.retries) == 0
+    assert bus.retries.dead_letters.list() == []
+
+
+def test_retries_back_off_exponentially():
+    handler, calls = flaky(times=2)
+    bus, clock = make_bus(handler, max_attempts=5)
+    bus.handle(events.OutOfStock("SMALL-FORK"))
+
+    clock.now = 1
+    bus.retries.run_pending()
+    clock.now = 2.9
+    assert bus.retries.run_pending() == 0
+
+    clock.now = 3
+    assert bus.retries.run_pending() == 1
+    assert len(calls) == 3
+
+
+def test_handlers_are_dead_lettered_once_attempts_run_out():
+    handler, calls = flaky(times=10)
+    bus, clock = make_bus(handler, max_attempts=3)
+    bus.handle(events.OutOfStock("SMALL-FORK"))
+
+    for clock.now in (1, 3, 7):
+        bus.retries.run_pending()
+
+    assert len(calls) == 3
+    assert len(bus.retries) == 0
+    [letter] = bus.retries.dead_letters.list()
+    assert letter.handler == "handler"
+    assert letter.event == events.OutOfStock("SMALL-FORK")
+    assert letter.attempts == 3
+    assert "redis is down" in letter.error
+
+
+def test_dead_letters_can_be_replayed():
+    handler, calls = flaky(times=2)
+    bus, clock = make_bus(handler, max_attempts=2)
+    bus.handle(events.OutOfStock("SMALL-FORK"))
+    clock.now = 1
+    bus.retries.run_pending()
+    store = bus.retries.dead_letters
+    assert len(store.list()) == 1
+
+    failed = retries.replay_dead_letters(store, bus.retry_handler, bus.find_handler)
+
+    assert failed == []
+    assert len(calls) == 3
+    assert store.list() == []
+
+
+def test_the_worker_thread_runs_due_retries():
+    handler, calls = flaky(times=1)
+    bus = bootstrap.bootstrap(testing=True)
+    bus.EVENT_HANDLERS = {events.OutOfStock: [handler]}
+    bus.retries = retries.RetryScheduler(
+        bus.retry_handler, dead_letters.FakeDeadLetterStore(), base_delay=0.01
+    )
+    bus.retries.start()
+    try:
+        bus.handle(events.OutOfStock("SMALL-FORK"))
+        for _ in range(200):
+            if len(calls) == 2:
+                break
+            retries.time.sleep(0.01)
+    finally:
+        bus.retries.stop(timeout=1)
+    assert len(calls) == 2
+
+
+class FailingDeadLetterStore(dead_letters.FakeDeadLetterStore):
+    def add(self, letter):
+        raise ConnectionError("postgres is down")
+
+
+def test_the_worker_thread_survives_a_failing_dead_letter_store():
+    handler, calls = flaky(times=1)
+    failing, failing_calls = flaky(times=10)
+    failing.__name__ = "failing"
+    bus = bootstrap.bootstrap(testing=True)
+    bus.EVENT_HANDLERS = {events.OutOfStock: [failing, handler]}
+    bus.retries = retries.RetryScheduler(
+        bus.retry_handler, FailingDeadLetterStore(), max_attempts=2, base_delay=0.01
+    )
+    bus.retries.start()
+    try:
+        bus.handle(events.OutOfStock("SMALL-FORK"))
+        for _ in range(200):
+            if len(calls) == 2 and len(failing_calls) == 2:
+                break
+            retries.time.sleep(0.01)
+        worker = bus.retries._worker
+        assert worker is not None and worker.is_alive()
+    finally:
+        bus.retries.stop(timeout=1)
+    assert len(failing_calls) == 2
+    assert len(calls) == 2
+    assert len(bus.retries) == 0
+
+
+def test_dead_letters_round_trip_dates():
+    event = events.BatchCreated("SMALL-FORK", "batch1", date(2021, 10, 7), 10)
+
+    payload = dead_letters.encode_event(event)
+
+    assert dead_letters.decode_event("BatchCreated", payload) == event
@@ -0,0 +1,288 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+from ddd_python import metrics
+from ddd_python.adapters import database, email, event_publisher, repository
+from ddd_python.domain import events, model
+from ddd_python.service_layer import errors, handlers, unit_of_work
+
+
+def make_uow(session_factory, cache):
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        email.FakeEmailAdapter(),
+        event_publisher.FakePublisherAdapter(),
+        session_factory=session_factory,
+        cache=cache,
+    )
+
+
+def add_product(session_factory, sku):
+    with session_factory() as session:
+        batch = model.Batch("batch1", sku, 100, eta=date.today())
+        session.add(model.Product(sku, [batch]))
+        session.commit()
+
+
+def allocate(uow, sku, orderid):
+    with uow:
+        product = uow.products.get(sku)
+        product.allocate(model.OrderLine(orderid, sku, 1))
+        uow.commit()
+    list(uow.collect_new_events())
+    return product
+
+
+def test_committed_products_are_served_from_the_cache(session_factory):
+    cache = repository.ProductCache()
+    add_product(session_factory, "RETRO-CLOCK")
+
+    first = allocate(make_uow(session_factory, cache), "RETRO-CLOCK", "order1")
+    second = allocate(make_uow(session_factory, cache), "RETRO-CLOCK", "order2")
+
+    assert second is first
+    assert second.batches[0].available_quantity == 98
+    assert cache.stats()["hits"] == 1
+    with session_factory() as session:
+        [[allocated]] = session.execute("SELECT count(*) FROM order_lines")
+    assert allocated == 2
+
+
+def test_stale_products_are_reloaded(session_factory):
+    cache = repository.ProductCache()
+    add_product(session_factory, "RETRO-CLOCK")
+    cached = allocate(make_uow(session_factory, cache), "RETRO-CLOCK", "order1")
+    with session_factory() as session:
+        session.execute("UPDATE products SET version_number = version_number + 1")
+        session.commit()
+
+    product = allocate(make_uow(session_factory, cache), "RETRO-CLOCK", "order2")
+
+    assert product is not cached
+    assert cache.stats()["stale"] == 1
+
+
+def test_uncommitted_products_are_not_cached(session_factory):
+    cache = repository.ProductCache()
+    add_product(session_factory, "RETRO-CLOCK")
+    uow = make_uow(session_factory, cache)
+
+    with uow:
+        product = uow.products.get("RETRO-CLOCK")
+        product.allocate(model.OrderLine("order1", "RETRO-CLOCK", 1))
+    list(uow.collect_new_events())
+
+    assert len(cache) == 0
+
+
+def test_cache_evicts_least_recently_used_products():
+    cache = repository.ProductCache(max_entries=2)
+    for sku in ["RETRO-CLOCK", "SMALL-FORK", "RETRO-CLOCK", "GENERIC-SOFA"]:
+        cache.checkin(model.Product(sku, []))
+
+    assert cache.checkout("SMALL-FORK") is None
+    assert cache.checkout("RETRO-CLOCK") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_get_many_serves_cached_products_and_loads_the_rest(session_factory):
+    cache = repository.ProductCache()
+    add_product(session_factory, "RETRO-CLOCK")
+    with session_factory() as session:
+        session.add(model.Product("SMALL-FORK", []))
+        session.commit()
+    cached = allocate(make_uow(session_factory, cache), "RETRO-CLOCK", "order1")
+    uow = make_uow(session_factory, cache)
+
+    with uow:
+        products = uow.products.get_many(["RETRO-CLOCK", "SMALL-FORK"])
+
+    assert cached in products
+    assert {product.sku for product in products} == {"RETRO-CLOCK", "SMALL-FORK"}
+    assert cache.stats()["hits"] == 1
+
+
+def test_concurrent_updates_to_a_product_conflict(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    first, second = make_uow(session_factory, None), make_uow(session_factory, None)
+
+    with first:
+        with second:
+            for uow, orderid in [(first, "order1"), (second, "order2")]:
+                product = uow.products.get("RETRO-CLOCK")
+                product.allocate(model.OrderLine(orderid, "RETRO-CLOCK", 1))
+            first.commit()
+            with pytest.raises(errors.ConcurrencyConflict):
+                second.commit()
+
+    with session_factory() as session:
+        orders = list(session.execute("SELECT orderid FROM order_lines"))
+        [[version_number]] = session.execute("SELECT version_number FROM products")
+        [[outboxed]] = session.execute("SELECT count(*) FROM outbox")
+    assert orders == [("order1",)]
+    assert version_number == 1
+    # the losing commit's events were rolled back with it
+    assert outboxed == 1
+
+
+def test_events_are_written_to_the_outbox_on_commit(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    uow = make_uow(session_factory, None)
+
+    with uow:
+        product = uow.products.get("RETRO-CLOCK")
+        product.allocate(model.OrderLine("order1", "RETRO-CLOCK", 1))
+        product.allocate(model.OrderLine("order2", "RETRO-CLOCK", 1000))
+    with session_factory() as session:
+        assert list(session.execute("SELECT channel FROM outbox")) == []
+
+    allocate(uow, "RETRO-CLOCK", "order1")
+    with session_factory() as session:
+        rows = list(session.execute("SELECT channel, payload, sent_at FROM outbox"))
+    # OutOfStock is internal and never leaves the service
+    assert rows == [
+        (
+            "line_allocated",
+            b'{"v":1,"orderid":"order1","sku":"RETRO-CLOCK","qty":1,'
+            b'"batchref":"batch1"}',
+            None,
+        )
+    ]
+
+
+def count_commits(session_factory):
+    commits = []
+    event.listen(session_factory.kw["bind"], "commit", commits.append)
+    return commits
+
+
+def test_batch_commits_every_block_once(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    commits = count_commits(session_factory)
+    uow = make_uow(session_factory, None)
+
+    with uow.batch():
+        for orderid in ["order1", "order2"]:
+            with uow:
+                product = uow.products.get("RETRO-CLOCK")
+                product.allocate(model.OrderLine(orderid, "RETRO-CLOCK", 1))
+                uow.commit()
+
+    assert len(commits) == 1
+    with session_factory() as session:
+        orders = list(session.execute("SELECT orderid FROM order_lines"))
+    assert orders == [("order1",), ("order2",)]
+
+
+def test_batch_rolls_back_only_the_failed_block(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    uow = make_uow(session_factory, None)
+
+    with uow.batch():
+        with pytest.raises(ZeroDivisionError):
+            with uow:
+                product = uow.products.get("RETRO-CLOCK")
+                product.allocate(model.OrderLine("order1", "RETRO-CLOCK", 100))
+                1 / 0
+        with uow:
+            product = uow.products.get("RETRO-CLOCK")
+            # the failed allocation must not hold on to any stock
+            assert product.allocate(model.OrderLine("order2", "RETRO-CLOCK", 100))
+            uow.commit()
+
+    with session_factory() as session:
+        orders = list(session.execute("SELECT orderid FROM order_lines"))
+    assert orders == [("order2",)]
+
+
+def test_a_batch_aborted_part_way_commits_nothing(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    uow = make_uow(session_factory, None)
+
+    with pytest.raises(ZeroDivisionError):
+        with uow.batch():
+            with uow:
+                product = uow.products.get("RETRO-CLOCK")
+                product.allocate(model.OrderLine("order1", "RETRO-CLOCK", 1))
+                uow.commit()
+            1 / 0
+
+    with session_factory() as session:
+        orders = list(session.execute("SELECT orderid FROM order_lines"))
+    assert orders == []
+
+
+def allocate_in_batch(uow, orderid):
+    with uow:
+        product = uow.products.get("RETRO-CLOCK")
+        product.allocate(model.OrderLine(orderid, "RETRO-CLOCK", 1))
+        uow.commit()
+    for allocated in uow.collect_new_events():
+        uow.projections.insert_allocation(
+            allocated.orderid, allocated.sku, allocated.batchref
+        )
+
+
+def test_batch_read_model_changes_are_written_after_it_commits(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    uow = make_uow(session_factory, None)
+
+    with uow.batch():
+        allocate_in_batch(uow, "order1")
+        assert uow.projections.pending() == 1
+        uow.projections.flush_if_due()
+    uow.projections.flush()
+
+    assert uow.projections is unit_of_work.projection_writer(session_factory)
+    with session_factory() as session:
+        views = list(session.execute("SELECT orderid FROM allocations_view"))
+    assert views == [("order1",)]
+
+
+def test_batch_read_model_changes_are_dropped_if_it_fails(session_factory):
+    add_product(session_factory, "RETRO-CLOCK")
+    uow = make_uow(session_factory, None)
+
+    with pytest.raises(errors.ConcurrencyConflict):
+        with uow.batch():
+            allocate_in_batch(uow, "order1")
+            uow.projections.flush_if_due()
+            raise errors.ConcurrencyConflict()
+    uow.projections.flush()
+
+    assert uow.projections.pending() == 0
+    with session_factory() as session:
+        views = list(session.execute("SELECT orderid FROM allocations_view"))
+    assert views == []
+
+
+def test_statements_are_counted_per_unit_of_work(session_factory, monkeypatch):
+    monkeypatch.setattr(metrics.REGISTRY, "enabled", True)
+    database.instrument_engine(session_factory.kw["bind"])
+    add_product(session_factory, "RETRO-CLOCK")
+    before = unit_of_work.UOW_SQL_STATEMENTS.count()
+
+    allocate(make_uow(session_factory, None), "RETRO-CLOCK", "order1")
+
+    assert unit_of_work.UOW_SQL_STATEMENTS.count() == before + 1
+    assert unit_of_work.UOW_SQL_SECONDS.count() >= 1
+
+
+def test_batchrefs_are_registered_without_opening_a_session():
+    def no_database():
+        raise AssertionError("no session should be opened")
+
+    batchrefs = repository.BatchrefIndex()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        email.FakeEmailAdapter(),
+        event_publisher.FakePublisherAdapter(),
+        session_factory=no_database,
+        batchrefs=batchrefs,
+    )
+
+    handlers.add_batch_to_batchref_index(
+        events.BatchCreated("RETRO-CLOCK", "batch1", date.today(), 10), uow, None
+    )
+
+    assert batchrefs.get("batch1") == "RETRO-CLOCK"
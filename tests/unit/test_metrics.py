@@ -0,0 +1,71 @@
+import pytest
+
+from ddd_python import metrics
+from ddd_python.domain import commands, events
+from ddd_python.service_layer import messagebus
+from ddd_python.service_layer.bootstrap import bootstrap
+
+
+@pytest.fixture()
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics.REGISTRY, "enabled", True)
+
+
+def test_a_disabled_registry_records_nothing():
+    registry = metrics.Registry(enabled=False)
+    latency = registry.histogram("latency_seconds", "Latency")
+    calls = registry.counter("calls_total", "Calls")
+
+    with latency.time():
+        calls.inc()
+
+    assert latency.count() == 0
+    assert calls.value() == 0
+
+
+def test_histograms_render_cumulative_buckets():
+    registry = metrics.Registry(enabled=True)
+    depth = registry.histogram("depth", "Depth", ["bus"], buckets=(1, 5))
+    for value in (1, 3, 4, 10):
+        depth.observe(value, "main")
+    registry.add_collector(lambda: [("pool_size", {}, 5)])
+
+    assert registry.render().splitlines() == [
+        "# HELP depth Depth",
+        "# TYPE depth histogram",
+        'depth_bucket{bus="main",le="1"} 1',
+        'depth_bucket{bus="main",le="5"} 3',
+        'depth_bucket{bus="main",le="+Inf"} 4',
+        'depth_sum{bus="main"} 18.0',
+        'depth_count{bus="main"} 4',
+        "pool_size 5",
+    ]
+
+
+def test_the_bus_times_commands_and_event_handlers(enabled):
+    bus = bootstrap(testing=True)
+    handled_before = messagebus.HANDLER_SECONDS.count("add_product_to_read_model")
+    commands_before = messagebus.COMMAND_SECONDS.count("CreateProduct")
+    depths_before = messagebus.QUEUE_DEPTH.count()
+
+    bus.handle(commands.CreateProduct("LAMP"))
+
+    assert messagebus.COMMAND_SECONDS.count("CreateProduct") == commands_before + 1
+    assert (
+        messagebus.HANDLER_SECONDS.count("add_product_to_read_model")
+        == handled_before + 1
+    )
+    assert messagebus.QUEUE_DEPTH.count() == depths_before + 1
+
+
+def test_the_bus_counts_failed_event_handlers(enabled):
+    def broken(event, uow, queue):
+        raise ValueError("boom")
+
+    bus = bootstrap(testing=True)
+    bus.EVENT_HANDLERS = {events.OutOfStock: [broken]}
+    before = messagebus.HANDLER_FAILURES.value("broken")
+
+    bus.handle(events.OutOfStock("LAMP"))
+
+    assert messagebus.HANDLER_FAILURES.value("broken") == before + 1